@@ -1,21 +1,31 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
 from fastapi import HTTPException, status, Depends, Header, Request
-from passlib.context import CryptContext
-from cryptography.fernet import Fernet
-import base64
 from app.models import UserCreate, UserLogin, User
-from app.database import load_users, save_users
+from app.storage import storage, UserExistsError
+from app.hashing import hashing_pool, HashQueueFull
+from app.services import run_blocking
+from app.crypto import generate_user_key
+from app.config import settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def register_user(user:UserCreate) -> dict:
-    users = load_users()
+def _overloaded() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Сервер перегружен, попробуйте позже",
+        headers={"Retry-After": str(settings.hash_retry_after)},
+    )
 
-    if any(u.username == user.username for u in users):
+async def register_user(user:UserCreate) -> dict:
+    if await run_blocking(storage.get_user, user.username) is not None:
         raise HTTPException(status_code=409, detail="Пользователь уже существует")
 
-    hashed_password = pwd_context.hash(user.password)
-    fernet_key = Fernet.generate_key()
-    encrypted_user_key = base64.urlsafe_b64encode(fernet_key).decode()
+    try:
+        hashed_password = await hashing_pool.hash(user.password)
+    except HashQueueFull:
+        raise _overloaded()
+    encrypted_user_key = generate_user_key()
 
     new_user = User(
         username=user.username,
@@ -23,38 +33,95 @@ def register_user(user:UserCreate) -> dict:
         encrypted_user_key=encrypted_user_key
     )
 
-    users.append(new_user)
-    save_users(users)
-
-    return {"username": new_user.username}
+    try:
+        await run_blocking(storage.add_user, new_user)
+    except UserExistsError:
+        raise HTTPException(status_code=409, detail="Пользователь уже существует")
 
-def login_user(credentials: UserLogin) -> dict:
-    users = load_users()
+    return {"username": new_user.username, "user": new_user}
 
-    user = next((u for u in users if u.username == credentials.username), None)
+async def login_user(credentials: UserLogin) -> dict:
+    user = await run_blocking(storage.get_user, credentials.username)
     if not user:
         raise HTTPException(status_code=401, detail="Неверное имя пользователя или пароль")
 
-    if not pwd_context.verify(credentials.password, user.hashed_password):
+    try:
+        verified, new_hash = await hashing_pool.verify_and_update(credentials.password, user.hashed_password)
+    except HashQueueFull:
+        raise _overloaded()
+    if not verified:
         raise HTTPException(status_code=401, detail="Неверное имя пользователя или пароль")
 
+    # Хэш со старой стоимостью или схемой заменяем прозрачно для пользователя
+    if new_hash:
+        await run_blocking(storage.update_user_fields, user.username, {"hashed_password": new_hash})
+
     return {
         "message": "Вход выполнен успешно",
         "username": user.username,
-        "user_key": user.encrypted_user_key
+        "user_key": user.encrypted_user_key,
+        "user": user,
     }
 
-def get_current_username(X_Username: str = Header(None)):
-    if not X_Username:
+# Кэш пользователей на время одного запроса: middleware открывает его, а зависимости
+# и обработчики получают пользователя через resolve_user — хранилище читается не больше
+# одного раза за запрос. anyio копирует контекст в потоки пула, поэтому словарь общий
+# и для синхронных обработчиков.
+_request_users: ContextVar[Optional[Dict[str, Optional[User]]]] = ContextVar("request_users", default=None)
+
+
+@contextmanager
+def request_user_cache():
+    token = _request_users.set({})
+    try:
+        yield
+    finally:
+        _request_users.reset(token)
+
+
+def remember_user(username: str, user: Optional[User]):
+    cache = _request_users.get()
+    if cache is not None:
+        cache[username] = user
+
+
+def _cached_user(username: str):
+    cache = _request_users.get()
+    if cache is not None and username in cache:
+        return True, cache[username]
+    found, user = storage.get_user_cached(username)
+    if found:
+        remember_user(username, user)
+    return found, user
+
+
+def resolve_user(username: str) -> Optional[User]:
+    found, user = _cached_user(username)
+    if not found:
+        user = storage.get_user(username)
+        remember_user(username, user)
+    return user
+
+
+async def resolve_user_async(username: str) -> Optional[User]:
+    found, user = _cached_user(username)
+    if not found:
+        user = await run_blocking(storage.get_user, username)
+        remember_user(username, user)
+    return user
+
+
+def get_current_username(request: Request, X_Username: str = Header(None)):
+    # имя, уже установленное AuthMiddleware, важнее заголовка
+    username = getattr(request.state, "username", None) or X_Username
+    if not username:
         raise HTTPException(status_code=401, detail="Требуется заголовок X-Username")
-    users = load_users()
-    if not any(u.username == X_Username for u in users):
+    if resolve_user(username) is None:
         raise HTTPException(status_code=401, detail="Пользователь не найден")
-    return X_Username
+    return username
 
 def get_user_key(username: str = Depends(get_current_username)) -> str:
-    users = load_users()
-    user = next((u for u in users if u.username == username), None)
+    user = resolve_user(username)
     if not user:
         raise HTTPException(status_code=401, detail="Пользователь не найден")
     return user.encrypted_user_key
\ No newline at end of file
@@ -0,0 +1,98 @@
+from typing import Literal, Optional
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="PM_", env_file=".env", extra="ignore")
+
+    # Как сохраняются записи паролей:
+    # "snapshot" — файл перезаписывается целиком при каждом изменении,
+    # "journal" — изменения дописываются в журнал, который периодически сворачивается в снимок,
+    # "sharded" — отдельный файл records/<хэш имени>.json на каждого пользователя
+    records_storage: Literal["snapshot", "journal", "sharded"] = "snapshot"
+    journal_max_bytes: int = 4 * 1024 * 1024
+    journal_max_ops: int = 10_000
+    # Окно групповой фиксации: записи, пришедшие в течение этого времени,
+    # сбрасываются на диск одним fsync
+    commit_window_ms: float = 2.0
+    # Сколько id записей процесс резервирует за одно обращение к файлу последовательности
+    id_block_size: int = 100
+
+    # Хранилище данных: "json" — файлы users.json / password_records.json,
+    # "sqlite" — база SQLite (перенос данных: python -m app.storage migrate)
+    storage_backend: Literal["json", "sqlite"] = "json"
+    sqlite_path: str = "venv/app/passwords.db"
+    # Размер пула соединений; по умолчанию равен пулу рабочих потоков
+    storage_pool_size: Optional[int] = None
+
+    # Пул потоков для блокирующих операций: sync-обработчики FastAPI, работа с хранилищем
+    # и шифрование из async-обработчиков (app.services.run_blocking)
+    worker_threads: int = 40
+
+    # Пул процессов для bcrypt: число процессов и сколько запросов может ждать в очереди.
+    # При переполнении очереди вход/регистрация отвечают 503 с Retry-After
+    hash_workers: int = 2
+    hash_queue_size: int = 32
+    hash_retry_after: int = 2
+
+    # Стоимость bcrypt. 0 — подобрать при запуске под бюджет bcrypt_target_ms
+    # (или заранее: python -m app.hashing calibrate); результат общий для всех воркеров
+    # и сохраняется в venv/app/bcrypt.rounds. Хэши с другой стоимостью
+    # перехэшируются при следующем успешном входе
+    bcrypt_rounds: int = 12
+    bcrypt_target_ms: float = 150.0
+    bcrypt_min_rounds: int = 10
+
+    # Ограничение попыток входа/регистрации по имени пользователя и по адресу клиента:
+    # token bucket (rate в минуту, burst) и пауза после неудачи, удваивающаяся до backoff_max секунд
+    login_rate_per_minute: float = 10
+    login_burst: int = 5
+    login_backoff_base: float = 1.0
+    login_backoff_max: float = 300.0
+    login_throttle_ttl: float = 3600.0
+    login_throttle_max_keys: int = 100_000
+
+    # Формат новых зашифрованных паролей: "aesgcm" (v2) или "fernet".
+    # Записи в другом формате перешифровываются при следующем изменении или фоновым проходом после входа
+    cipher_format: Literal["aesgcm", "fernet"] = "aesgcm"
+
+    # Кэш шифров по ключу пользователя
+    cipher_cache_size: int = 1024
+    cipher_cache_ttl: float = 600.0
+    # Размер страницы списка записей по умолчанию и максимальный (параметр limit)
+    page_size: int = 100
+    page_size_max: int = 1000
+    # Сколько результатов поиска возвращать по умолчанию и максимум
+    search_limit: int = 20
+    search_limit_max: int = 200
+    # Файл Public Suffix List для поиска записей по адресу сайта (None — встроенный список, см. app.domains)
+    public_suffix_file: Optional[str] = None
+    # Синхронизация (/passwords/sync): удаления хранятся за последние sync_retention версий
+    # хранилища; клиент, отставший сильнее (если что-то удалялось), получает full_resync
+    sync_retention: int = 10_000
+
+    # Потоки для encrypt_many/decrypt_many (None — по числу ядер)
+    crypto_workers: Optional[int] = None
+
+    # Сессии: "token" — подписанный токен (JWT) в cookie "session",
+    # "server" — случайный идентификатор в cookie "sid", данные сессии в памяти процесса,
+    # "cookie" — прежний режим с именем пользователя в cookie X-Username.
+    # Секрет подписи: session_secret (не короче 32 символов) или случайный, сохранённый в venv/app/session.secret
+    session_mode: Literal["token", "server", "cookie"] = "token"
+    session_secret: Optional[str] = None
+    session_ttl: float = 900.0
+    # Сколько секунд ключ шифрования пользователя берётся из памяти без обращения к хранилищу
+    session_key_ttl: float = 5.0
+    session_key_cache_size: int = 100_000
+    # Режим "server": лимит памяти на все сессии и период удаления истёкших
+    session_store_max_bytes: int = 64 * 1024 * 1024
+    session_reap_interval: float = 60.0
+
+    # Смена ключа пользователя: размер пакета, пауза между пакетами и задержка
+    # перед первым пакетом (даёт завершиться запросам, начатым со старым ключом)
+    key_rotation_batch: int = 50
+    key_rotation_pause: float = 0.05
+    key_rotation_grace: float = 5.0
+
+
+settings = Settings()
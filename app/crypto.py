@@ -0,0 +1,189 @@
+import hashlib
+import os
+import threading
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple, Union
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from app.config import settings
+
+# Формат зашифрованного пароля определяется префиксом:
+#   "v2:" + base64url(nonce[12] + шифротекст + тег[16]) — AES-256-GCM;
+#   без префикса — токен Fernet (все записи, созданные до появления версий).
+AESGCM_PREFIX = "v2:"
+_AESGCM_INFO = b"password-manager record encryption v2"
+
+
+# Шифры одного пользователя. Ключ AES-GCM выводится из того же ключа
+# пользователя через HKDF, поэтому старые записи Fernet остаются читаемыми,
+# а новые пишутся в формате cipher_format.
+class UserCipher:
+    def __init__(self, key_b64: str):
+        fernet_key = urlsafe_b64decode(key_b64)
+        self.fernet = Fernet(fernet_key)
+        aes_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=_AESGCM_INFO).derive(
+            urlsafe_b64decode(fernet_key)
+        )
+        self.aesgcm = AESGCM(aes_key)
+
+    def encrypt(self, plain: str) -> str:
+        if settings.cipher_format == "fernet":
+            return self.fernet.encrypt(plain.encode()).decode()
+        nonce = os.urandom(12)
+        sealed = self.aesgcm.encrypt(nonce, plain.encode(), None)
+        return AESGCM_PREFIX + urlsafe_b64encode(nonce + sealed).rstrip(b"=").decode()
+
+    def decrypt(self, enc: str) -> str:
+        if enc.startswith(AESGCM_PREFIX):
+            body = enc[len(AESGCM_PREFIX):]
+            raw = urlsafe_b64decode(body + "=" * (-len(body) % 4))
+            return self.aesgcm.decrypt(raw[:12], raw[12:], None).decode()
+        return self.fernet.decrypt(enc.encode()).decode()
+
+
+def needs_upgrade(enc: str) -> bool:
+    if settings.cipher_format == "fernet":
+        return enc.startswith(AESGCM_PREFIX)
+    return not enc.startswith(AESGCM_PREFIX)
+
+
+# LRU-кэш готовых шифров: декодирование ключа и вывод подключей
+# выполняются один раз на ключ, а не на каждый encrypt/decrypt. Ключом кэша служит
+# SHA-256 от ключа пользователя, чтобы сам ключ не оставался в словаре лишний раз.
+# Записи старше ttl пересоздаются; invalidate() удаляет ключ сразу (смена ключа пользователя).
+class CipherCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[bytes, Tuple[UserCipher, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(key_b64: str) -> bytes:
+        return hashlib.sha256(key_b64.encode()).digest()
+
+    def get(self, key_b64: str) -> UserCipher:
+        digest = self._digest(key_b64)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        cipher = UserCipher(key_b64)
+        with self._lock:
+            self._entries[digest] = (cipher, now)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return cipher
+
+    def invalidate(self, key_b64: str):
+        with self._lock:
+            self._entries.pop(self._digest(key_b64), None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+cipher_cache = CipherCache(settings.cipher_cache_size, settings.cipher_cache_ttl)
+
+
+# Новый ключ пользователя: ключ Fernet, ещё раз закодированный в base64
+def generate_user_key() -> str:
+    return urlsafe_b64encode(Fernet.generate_key()).decode()
+
+
+def encrypt(plain: str, key_b64: str) -> str:
+    return cipher_cache.get(key_b64).encrypt(plain)
+
+
+# Во время смены ключа запись может быть ещё зашифрована прежним ключом
+def _decryptor(key_b64: str, previous_key_b64: Optional[str]) -> Callable[[str], str]:
+    current = cipher_cache.get(key_b64)
+    if previous_key_b64 is None:
+        return current.decrypt
+    previous = cipher_cache.get(previous_key_b64)
+
+    def decrypt_either(enc: str) -> str:
+        try:
+            return current.decrypt(enc)
+        except Exception:
+            return previous.decrypt(enc)
+    return decrypt_either
+
+
+def decrypt(enc: str, key_b64: str, previous_key_b64: Optional[str] = None) -> str:
+    return _decryptor(key_b64, previous_key_b64)(enc)
+
+
+# Пакетная обработка: шифр берётся из кэша один раз на весь пакет, пакет делится
+# на части по числу потоков. OpenSSL отпускает GIL, поэтому части выполняются параллельно.
+# Ошибка одного элемента не прерывает пакет — на его месте возвращается исключение.
+BATCH_INLINE_LIMIT = 256
+_batch_pool: Optional[ThreadPoolExecutor] = None
+_batch_pool_lock = threading.Lock()
+BatchResult = List[Union[str, Exception]]
+
+
+def _batch_workers() -> int:
+    return settings.crypto_workers or os.cpu_count() or 1
+
+
+def _get_batch_pool() -> ThreadPoolExecutor:
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPoolExecutor(max_workers=_batch_workers(), thread_name_prefix="crypto")
+        return _batch_pool
+
+
+def _apply(func: Callable[[str], str], items: Sequence[str]) -> BatchResult:
+    results: BatchResult = []
+    for item in items:
+        try:
+            results.append(func(item))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _map_batch(func: Callable[[str], str], items: Iterable[str]) -> BatchResult:
+    items = list(items)
+    workers = _batch_workers()
+    if workers == 1 or len(items) < BATCH_INLINE_LIMIT:
+        return _apply(func, items)
+    size = -(-len(items) // workers)
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    results: BatchResult = []
+    for part in _get_batch_pool().map(_apply, repeat(func), chunks):
+        results.extend(part)
+    return results
+
+
+def encrypt_many(plains: Iterable[str], key_b64: str) -> BatchResult:
+    return _map_batch(cipher_cache.get(key_b64).encrypt, plains)
+
+
+def decrypt_many(encs: Iterable[str], key_b64: str, previous_key_b64: Optional[str] = None) -> BatchResult:
+    return _map_batch(_decryptor(key_b64, previous_key_b64), encs)
+
+
+# Перешифровывает пароль в текущий формат, если он записан в другом
+def upgrade(enc: str, key_b64: str) -> str:
+    if not needs_upgrade(enc):
+        return enc
+    cipher = cipher_cache.get(key_b64)
+    return cipher.encrypt(cipher.decrypt(enc))
@@ -1,35 +1,1000 @@
+import hashlib
 import json
 import os
-from typing import List, Dict, Any
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import List, Dict, Any, Optional, Tuple
 from .models import User
+from .config import settings
+from .indexes import DomainIndex, SearchIndex, SortedOrder, SortKey, VersionOrder
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка работает только между потоками одного процесса
+    fcntl = None
 
 USERS_FILE = "venv/app/users.json"
 RECORDS_FILE = "venv/app/password_records.json"
+RECORDS_JOURNAL_FILE = "venv/app/password_records.journal"
+RECORDS_DIR = "venv/app/records"
+RECORDS_SEQUENCE_FILE = "venv/app/password_records.seq"
 
-def load_users() -> List[User]:
-    if not os.path.exists(USERS_FILE):
-        return []
+
+# Групповая фиксация: записи, пришедшие почти одновременно, сбрасываются
+# на диск одним flush + fsync. submit() только ставит данные в очередь,
+# wait() блокирует до тех пор, пока они не окажутся на диске.
+class GroupCommit:
+    def __init__(self, flush, window: float = 0.002):
+        self._flush = flush
+        self._window = window
+        self._cond = threading.Condition()
+        self._batch: List[Any] = []
+        self._submitted = 0
+        self._durable = 0
+        self._flushing = False
+
+    def submit(self, item) -> int:
+        with self._cond:
+            self._batch.append(item)
+            self._submitted += 1
+            return self._submitted
+
+    def wait(self, ticket: int):
+        with self._cond:
+            while self._durable < ticket:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                # этот поток становится ведущим и пишет за всех, кто успел встать в очередь
+                self._flushing = True
+                self._cond.release()
+                try:
+                    time.sleep(self._window)
+                finally:
+                    self._cond.acquire()
+                batch, upto = self._batch, self._submitted
+                self._batch = []
+                self._cond.release()
+                try:
+                    self._flush(batch)
+                except BaseException:
+                    self._cond.acquire()
+                    self._batch[:0] = batch
+                    self._flushing = False
+                    self._cond.notify_all()
+                    raise
+                self._cond.acquire()
+                self._durable = upto
+                self._flushing = False
+                self._cond.notify_all()
+
+    def commit(self, item):
+        self.wait(self.submit(item))
+
+
+# В Windows os.replace отказывает (PermissionError), пока другой поток держит файл
+# открытым — ReadCache разбирает users.json, лидер фиксации дописывает журнал.
+# Такие файлы открываются ненадолго, поэтому замена повторяется с нарастающей паузой
+# (в сумме около 1.3 с); в POSIX замена открытого файла удаётся с первой попытки.
+_REPLACE_ATTEMPTS = 8
+
+
+def _replace(src: str, dst: str):
+    for attempt in range(_REPLACE_ATTEMPTS):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == _REPLACE_ATTEMPTS - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+
+
+def _fsync_dir(directory: str):
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Временный файл (права 0600) рядом с path, записанный write(f) и сброшенный на диск
+def _write_temp(path: str, write) -> str:
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return tmp_path
+
+
+def _write_json_temp(path: str, data: Any) -> str:
+    return _write_temp(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=2))
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Запись во временный файл рядом с целевым, fsync и атомарная замена:
+# читатель всегда видит либо старую, либо новую версию файла целиком.
+def write_json_atomic(path: str, data: Any):
+    _replace_with(_write_json_temp(path, data), path)
+
+
+def write_text_atomic(path: str, text: str):
+    _replace_with(_write_temp(path, lambda f: f.write(text)), path)
+
+
+def _replace_with(tmp_path: str, path: str):
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return [User(**u) for u in data]
+        _replace(tmp_path, path)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    _fsync_dir(os.path.dirname(path) or ".")
+
+
+# Блокировка файла данных между процессами (flock на <файл>.lock) и между потоками.
+# В самом lock-файле хранится версия данных: писатель увеличивает её, когда
+# последний поток процесса отпускает эксклюзивную блокировку, а остальные
+# процессы по несовпадению версии понимают, что их копия в памяти устарела.
+# Потоки одного процесса держат блокировку совместно, поэтому их записи
+# по-прежнему объединяются групповой фиксацией.
+class FileLock:
+    def __init__(self, path: str):
+        self.path = path + ".lock"
+        self._cond = threading.Condition()
+        self._fd: Optional[int] = None
+        self._mode: Optional[str] = None
+        self._holders = 0
+        self._writers_waiting = 0
+        self._file_version = 0
+        self._known_version: Optional[int] = None
+        self._dirty = False
+
+    @property
+    def stale(self) -> bool:
+        return self._known_version != self._file_version
+
+    @property
+    def version(self) -> int:
+        return self._file_version
+
+    def mark_synced(self):
+        self._known_version = self._file_version
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    @contextmanager
+    def shared(self):
+        self._acquire(exclusive=False)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    @contextmanager
+    def exclusive(self):
+        self._acquire(exclusive=True)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    def _acquire(self, exclusive: bool):
+        with self._cond:
+            if exclusive:
+                self._writers_waiting += 1
+                try:
+                    while self._holders and self._mode == "sh":
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+            else:
+                while self._writers_waiting and self._mode != "ex":
+                    self._cond.wait()
+            if self._holders == 0:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._mode = "ex" if exclusive else "sh"
+                self._file_version = self._read_version()
+            self._holders += 1
+
+    def _release(self):
+        with self._cond:
+            self._holders -= 1
+            if self._holders:
+                return
+            try:
+                if self._dirty:
+                    self._file_version += 1
+                    self._write_version(self._file_version)
+                    self._known_version = self._file_version
+                    self._dirty = False
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+                self._mode = None
+                self._cond.notify_all()
+
+    def _read_version(self) -> int:
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        raw = os.read(self._fd, 32).strip()
+        return int(raw) if raw else 0
+
+    def _write_version(self, version: int):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, str(version).encode())
+        os.ftruncate(self._fd, len(str(version)))
+
+
+_committers: Dict[str, GroupCommit] = {}
+_committers_lock = threading.Lock()
+
+# В очередь снимка кладутся функции, возвращающие данные: пишется только
+# самая свежая из них, промежуточные состояния просто пропускаются.
+def _snapshot_committer(path: str) -> GroupCommit:
+    with _committers_lock:
+        committer = _committers.get(path)
+        if committer is None:
+            committer = GroupCommit(
+                lambda batch: write_json_atomic(path, batch[-1]()),
+                window=settings.commit_window_ms / 1000,
+            )
+            _committers[path] = committer
+        return committer
+
+# (st_mtime_ns, st_size, st_ino) файла или None, если его нет. Запись через os.replace
+# всегда даёт новый inode, дозапись меняет размер.
+def _file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+# Кэш разобранных файлов: пока (st_mtime_ns, st_size, st_ino) файла не изменились,
+# повторный разбор не нужен — хватает одного stat(). Запись через os.replace
+# всегда даёт новый inode, поэтому изменения из других воркеров видны сразу.
+class ReadCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str, parse):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = parse(path)
+        with self._lock:
+            self._entries[path] = (key, value)
+        return value
+
+    # Только уже разобранное значение, без чтения файла: (актуально ли, значение).
+    # Отсутствующий файл считается актуальным пустым значением.
+    def peek(self, path: str) -> Tuple[bool, Any]:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return True, None
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == (st.st_mtime_ns, st.st_size, st.st_ino):
+            self.hits += 1
+            return True, entry[1]
+        return False, None
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "files": len(self._entries)}
+
+
+read_cache = ReadCache()
+
+
+def cache_stats() -> Dict[str, int]:
+    return read_cache.stats()
+
+
+def _parse_users(path: str) -> Tuple[List[User], Dict[str, User]]:
+    with open(path, "r", encoding="utf-8") as f:
+        users = [User(**u) for u in json.load(f)]
+    return users, {u.username: u for u in users}
+
+
+def _load_users_cached() -> Tuple[List[User], Dict[str, User]]:
+    try:
+        return read_cache.get(USERS_FILE, _parse_users) or ([], {})
     except (json.JSONDecodeError, FileNotFoundError, Exception):
         print(" users.json повреждён или пуст. Создаём новый.")
-        return []
+        return [], {}
+
+
+def load_users() -> List[User]:
+    return list(_load_users_cached()[0])
+
+
+def find_user(username: str) -> Optional[User]:
+    return _load_users_cached()[1].get(username)
+
+
+# Поиск по индексу в памяти без разбора users.json; (False, None), если индекс устарел
+def find_user_cached(username: str) -> Tuple[bool, Optional[User]]:
+    fresh, parsed = read_cache.peek(USERS_FILE)
+    if not fresh:
+        return False, None
+    return True, parsed[1].get(username) if parsed else None
 
 def save_users(users: List[User]):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump([u.model_dump() for u in users], f, ensure_ascii=False, indent=2)
+    data = [u.model_dump(exclude_none=True) for u in users]
+    _snapshot_committer(USERS_FILE).commit(lambda: data)
+
+def _parse_json(path: str) -> Any:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-def load_records() -> List[Dict[str, Any]]:
-    if not os.path.exists(RECORDS_FILE):
-        return []
+
+# Файл записей: {"vaults": {имя: данные хранилища пользователя}, "records": [записи]}.
+# Данные хранилища — {"version": n, "deleted": [[версия, id], ...], "horizon": h}:
+# версия растёт при каждом изменении записей пользователя, deleted — недавние удаления
+# для синхронизации (см. with_deletion). Всё это пишется в тот же файл, что и записи,
+# поэтому после сбоя они не расходятся. Файлы старого формата — просто список записей.
+def _load_records_file(path: str) -> Dict[str, Any]:
     try:
-        with open(RECORDS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        data = read_cache.get(path, _parse_json) or []
     except json.JSONDecodeError:
-        return []
+        data = []
+    if isinstance(data, list):
+        return {"vaults": {}, "records": data}
+    return data
+
+
+# Возвращённые словари общие с кэшем: их нельзя менять на месте
+def load_records(path: str = RECORDS_FILE) -> List[Dict[str, Any]]:
+    return list(_load_records_file(path)["records"])
+
+
+def load_vaults(path: str = RECORDS_FILE) -> Dict[str, Dict[str, Any]]:
+    return dict(_load_records_file(path).get("vaults", {}))
+
+
+def save_records(data: Dict[str, Any], path: str = RECORDS_FILE):
+    _snapshot_committer(path).commit(lambda: data)
+
+
+# Данные хранилища после удаления записи: удаление запоминается с версией хранилища.
+# Хранятся только удаления за последние retention версий; horizon — версия самого
+# свежего забытого удаления: клиенту, синхронизированному до неё, нужна полная синхронизация.
+def with_deletion(vault: Dict[str, Any], record_id: int, version: int, retention: int) -> Dict[str, Any]:
+    deleted = vault.get("deleted", []) + [[version, record_id]]
+    horizon = vault.get("horizon", 0)
+    cutoff = version - retention
+    if deleted[0][0] <= cutoff:
+        kept = [entry for entry in deleted if entry[0] > cutoff]
+        horizon = max(horizon, deleted[len(deleted) - len(kept) - 1][0])
+        deleted = kept
+    return {**vault, "deleted": deleted, "horizon": horizon}
+
+
+# Последовательность id записей. В файле хранится граница уже выданных
+# блоков; процесс резервирует себе сразу block_size номеров под блокировкой
+# файла и дальше раздаёт их из памяти за O(1). Граница только растёт, поэтому
+# id удалённой записи (и номера из недоиспользованного блока) больше не выдаются.
+class IdSequence:
+    def __init__(self, path: str = RECORDS_SEQUENCE_FILE, block_size: int = 100):
+        self.path = path
+        self.block_size = block_size
+        self._file_lock = FileLock(path)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
+
+    # seed() возвращает первый свободный id, если файла последовательности ещё нет
+    def allocate(self, seed) -> int:
+        with self._lock:
+            if self._next >= self._limit:
+                self._reserve(seed)
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve(self, seed):
+        with self._file_lock.exclusive():
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    start = json.load(f)["next"]
+            else:
+                start = seed()
+            write_json_atomic(self.path, {"next": start + self.block_size})
+            self._file_lock.mark_dirty()
+        self._next, self._limit = start, start + self.block_size
+
+
+# Способы сохранения RecordStore на диск. Методы put/delete вызываются
+# под блокировкой хранилища сразу после изменения индексов в памяти и только
+# ставят запись в очередь; wait() вызывается уже после снятия блокировки,
+# чтобы параллельные изменения успели попасть в одну групповую фиксацию.
+class SnapshotPersister:
+    lazy = False
+
+    def __init__(self, path: str = RECORDS_FILE):
+        self.path = path
+        self.lock = FileLock(path)
+        self.ids = IdSequence(block_size=settings.id_block_size)
+        self._commit = _snapshot_committer(path)
+
+    def lock_for(self, username: str) -> FileLock:
+        return self.lock
+
+    def load(self) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        return load_records(self.path), load_vaults(self.path)
+
+    def allocate_id(self, store: "RecordStore") -> int:
+        return self.ids.allocate(lambda: store.max_id() + 1)
+
+    def put(self, store: "RecordStore", record: Dict[str, Any]) -> int:
+        return self._commit.submit(store.dump_data)
+
+    def delete(self, store: "RecordStore", record: Dict[str, Any]) -> int:
+        return self._commit.submit(store.dump_data)
+
+    def wait(self, ticket: int):
+        self._commit.wait(ticket)
+
+
+# Журнал изменений: каждая операция — одна строка JSON в конце файла.
+# При старте журнал проигрывается поверх последнего снимка, а когда он
+# разрастается, фоновый поток сворачивает его в новый снимок.
+class JournalPersister:
+    lazy = False
+
+    def __init__(self, path: str = RECORDS_FILE, journal_path: str = RECORDS_JOURNAL_FILE,
+                 max_bytes: int = 4 * 1024 * 1024, max_ops: int = 10_000):
+        self.path = path
+        self.journal_path = journal_path
+        self.compacting_path = journal_path + ".compacting"
+        self.max_bytes = max_bytes
+        self.max_ops = max_ops
+        self.lock = FileLock(path)
+        self.ids = IdSequence(block_size=settings.id_block_size)
+        self._commit = GroupCommit(self._write_lines, window=settings.commit_window_ms / 1000)
+        # лидер групповой фиксации пишет в журнал без блокировки хранилища;
+        # подмена журнала при свёртке ждёт, пока он допишет, иначе строки теряются
+        self._journal_mutex = threading.Lock()
+        self._bytes = 0
+        self._ops = 0
+        self._compactor: Optional[threading.Thread] = None
+
+    def lock_for(self, username: str) -> FileLock:
+        return self.lock
+
+    def allocate_id(self, store: "RecordStore") -> int:
+        return self.ids.allocate(lambda: store.max_id() + 1)
+
+    def load(self) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        records = {r["id"]: r for r in load_records(self.path)}
+        vaults = load_vaults(self.path)
+        # .compacting остаётся после сбоя во время свёртки — его операции тоже нужно применить
+        self._replay(self.compacting_path, records, vaults)
+        self._ops, self._bytes = self._replay(self.journal_path, records, vaults)
+        return list(records.values()), vaults
+
+    # Каждая операция несёт версию хранилища пользователя после изменения
+    # (в строках старого журнала её нет — версия тогда не меняется).
+    # Операции, которые уже есть в снимке, пропускаются: строки, стоявшие в очереди
+    # при начале свёртки, попадают и в снимок, и в новый журнал, а после сбоя
+    # во время свёртки старый .compacting проигрывается поверх более нового снимка.
+    # У пакета перешифрования одна версия на все строки, поэтому put с текущей
+    # версией применяется (это безопасно — запись та же), а del — нет.
+    @staticmethod
+    def _replay(path: str, records: Dict[int, Dict[str, Any]], vaults: Dict[str, Dict[str, Any]]):
+        ops = size = 0
+        if not os.path.exists(path):
+            return ops, size
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # недописанная строка после аварийного завершения
+                    continue
+                ops += 1
+                size += len(line.encode("utf-8"))
+                if "version" in entry:
+                    username = entry["record"]["username"] if entry["op"] == "put" else entry["username"]
+                    known = vaults.get(username, {}).get("version", 0)
+                    if entry["version"] < known or (entry["version"] == known and entry["op"] == "del"):
+                        continue
+                if entry["op"] == "put":
+                    records[entry["record"]["id"]] = entry["record"]
+                elif entry["op"] == "del":
+                    records.pop(entry["id"], None)
+                if "version" in entry:
+                    vault = {**vaults.get(username, {}), "version": entry["version"]}
+                    if entry["op"] == "del":
+                        vault = with_deletion(vault, entry["id"], entry["version"], settings.sync_retention)
+                    vaults[username] = vault
+        return ops, size
+
+    def put(self, store: "RecordStore", record: Dict[str, Any]) -> int:
+        return self._append({"op": "put", "record": record,
+                             "version": store.current_version(record["username"])}, store)
+
+    def delete(self, store: "RecordStore", record: Dict[str, Any]) -> int:
+        return self._append({"op": "del", "id": record["id"], "username": record["username"],
+                             "version": store.current_version(record["username"])}, store)
+
+    def wait(self, ticket: int):
+        self._commit.wait(ticket)
+
+    def _write_lines(self, lines: List[str]):
+        with self._journal_mutex, open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append(self, entry: Dict[str, Any], store: "RecordStore") -> int:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        ticket = self._commit.submit(line)
+        self._ops += 1
+        self._bytes += len(line.encode("utf-8"))
+        if self._ops >= self.max_ops or self._bytes >= self.max_bytes:
+            # строка уже в очереди и запись в индексе: сбой свёртки не должен превращать
+            # выполненное изменение в ошибку — счётчики не сброшены, и следующая запись повторит
+            try:
+                self._start_compaction(store)
+            except OSError as e:
+                print(f" Не удалось начать свёртку журнала записей: {e}")
+        return ticket
+
+    def _start_compaction(self, store: "RecordStore"):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        # строки, ещё стоящие в очереди, попадут уже в новый журнал — это безопасно:
+        # при проигрывании операции, которые уже есть в снимке, пропускаются (см. _replay)
+        with self._journal_mutex:
+            self._rotate_journal()
+        self._ops = self._bytes = 0
+        # снимок берётся под блокировкой хранилища, а пишется уже в фоне;
+        # вместе с ним запоминается, какими были файлы снимка и .compacting
+        snapshot = store.dump_data()
+        signature = (_file_signature(self.path), _file_signature(self.compacting_path))
+        self._compactor = threading.Thread(
+            target=self._compact, args=(snapshot, signature), name="records-compactor", daemon=True
+        )
+        self._compactor.start()
+
+    def _rotate_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        if os.path.exists(self.compacting_path):
+            # предыдущая свёртка не завершилась — дописываем текущий журнал к её файлу;
+            # журнал удаляется, только когда дописанное уже на диске
+            with open(self.journal_path, "r", encoding="utf-8") as src, \
+                    open(self.compacting_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.journal_path)
+        else:
+            _replace(self.journal_path, self.compacting_path)
+        _fsync_dir(os.path.dirname(self.journal_path) or ".")
+
+    def _compact(self, snapshot: Dict[str, Any], signature):
+        try:
+            tmp_path = _write_json_temp(self.path, snapshot)
+            # подмена снимка и удаление .compacting — под блокировкой, чтобы другой
+            # процесс не прочитал старый снимок без уже удалённого журнала
+            with self.lock.exclusive():
+                # Пока снимок писался, другой процесс мог начать или закончить свою свёртку:
+                # тогда в .compacting или в файле снимка есть операции, которых в нашем снимке нет.
+                # Такой снимок выбрасывается — всё нужное остаётся в .compacting и журнале.
+                if (_file_signature(self.path), _file_signature(self.compacting_path)) != signature:
+                    _remove_quietly(tmp_path)
+                    return
+                _replace(tmp_path, self.path)
+                _remove_quietly(self.compacting_path)
+            _fsync_dir(os.path.dirname(self.path) or ".")
+        except OSError as e:
+            print(f" Не удалось свернуть журнал записей: {e}")
+
+
+# Отдельный файл хранилища на каждого пользователя (records/<sha256 имени>.json)
+# и небольшой манифест со списком пользователей.
+# Запись пользователя загружается при первом обращении к ней, а изменение
+# перезаписывает только файл владельца.
+class ShardedPersister:
+    lazy = True
+
+    def __init__(self, directory: str = RECORDS_DIR, legacy_path: str = RECORDS_FILE):
+        self.directory = directory
+        self.legacy_path = legacy_path
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_lock = FileLock(self.manifest_path)
+        self.ids = IdSequence(block_size=settings.id_block_size)
+        self._manifest: Optional[Dict[str, Any]] = None
+        self._shard_locks: Dict[str, FileLock] = {}
+        self._shard_locks_lock = threading.Lock()
+
+    def shard_path(self, username: str) -> str:
+        digest = hashlib.sha256(username.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".json")
+
+    def lock_for(self, username: str) -> FileLock:
+        with self._shard_locks_lock:
+            lock = self._shard_locks.get(username)
+            if lock is None:
+                lock = self._shard_locks[username] = FileLock(self.shard_path(username))
+            return lock
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        with self.manifest_lock.shared():
+            return self._synced_manifest()
+
+    # вызывается под блокировкой манифеста
+    def _synced_manifest(self) -> Dict[str, Any]:
+        if self._manifest is None or self.manifest_lock.stale:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = self._split_legacy_file()
+            self.manifest_lock.mark_synced()
+        return self._manifest
+
+    def _update_manifest(self, change) -> Any:
+        with self.manifest_lock.exclusive():
+            manifest = self._synced_manifest()
+            result = change(manifest)
+            write_json_atomic(self.manifest_path, manifest)
+            self.manifest_lock.mark_dirty()
+            return result
+
+    # Первый запуск: раскладываем общий password_records.json по файлам пользователей
+    def _split_legacy_file(self) -> Dict[str, Any]:
+        os.makedirs(self.directory, exist_ok=True)
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        vaults = load_vaults(self.legacy_path)
+        for username in vaults:
+            by_user[username] = []
+        for record in load_records(self.legacy_path):
+            by_user.setdefault(record["username"], []).append(record)
+        for username, records in by_user.items():
+            vault = {username: vaults[username]} if username in vaults else {}
+            write_json_atomic(self.shard_path(username), {"vaults": vault, "records": records})
+        manifest = {
+            "max_id": max((r["id"] for rs in by_user.values() for r in rs), default=0),
+            "users": sorted(by_user),
+        }
+        write_json_atomic(self.manifest_path, manifest)
+        return manifest
+
+    def usernames(self) -> List[str]:
+        return list(self._load_manifest()["users"])
+
+    def load_user(self, username: str) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        path = self.shard_path(username)
+        return load_records(path), load_vaults(path)
+
+    def load(self) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        records, vaults = [], {}
+        for username in self.usernames():
+            user_records, user_vaults = self.load_user(username)
+            records += user_records
+            vaults.update(user_vaults)
+        return records, vaults
+
+    # max_id в манифесте нужен только для первого запуска последовательности
+    def allocate_id(self, store: "RecordStore") -> int:
+        return self.ids.allocate(lambda: self._load_manifest().get("max_id", 0) + 1)
+
+    def put(self, store: "RecordStore", record: Dict[str, Any]):
+        username = record["username"]
+        if username not in self._load_manifest()["users"]:
+            def register(manifest):
+                if username not in manifest["users"]:
+                    manifest["users"].append(username)
+            self._update_manifest(register)
+        return self._submit_shard(store, username)
+
+    def delete(self, store: "RecordStore", record: Dict[str, Any]):
+        return self._submit_shard(store, record["username"])
+
+    def _submit_shard(self, store: "RecordStore", username: str):
+        path = self.shard_path(username)
+        return path, _snapshot_committer(path).submit(lambda: store.dump_user_data(username))
+
+    def wait(self, ticket):
+        path, number = ticket
+        _snapshot_committer(path).wait(number)
+
+
+def _make_persister():
+    if settings.records_storage == "sharded":
+        return ShardedPersister()
+    if settings.records_storage == "journal":
+        return JournalPersister(
+            max_bytes=settings.journal_max_bytes,
+            max_ops=settings.journal_max_ops,
+        )
+    return SnapshotPersister()
+
+# Хранилище записей в памяти процесса: файл читается один раз,
+# дальше все обращения идут через индексы, а изменения сразу сохраняются на диск.
+# Если данные изменил другой процесс (версия в lock-файле не совпадает с нашей),
+# копия в памяти перечитывается перед чтением или изменением — так несколько
+# воркеров uvicorn не теряют записи друг друга.
+class RecordStore:
+    def __init__(self, persister=None):
+        self.persister = persister or SnapshotPersister()
+        self._lock = threading.RLock()
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._by_user: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        # производные индексы (app.indexes) по пользователям: имя -> индекс
+        self._derived: Dict[str, Dict[str, Any]] = {}
+        # данные хранилищ пользователей ({"version": n}); словари заменяются целиком, не меняются на месте
+        self._vaults: Dict[str, Dict[str, Any]] = {}
+
+    def _index(self, record: Dict[str, Any]):
+        old = self._by_id.get(record["id"])
+        self._by_id[record["id"]] = record
+        self._by_user.setdefault(record["username"], {})[record["id"]] = record
+        for index in self._derived.get(record["username"], {}).values():
+            if old is not None:
+                index.remove(old)
+            index.add(record)
+
+    def _unindex(self, record: Dict[str, Any]):
+        del self._by_id[record["id"]]
+        for index in self._derived.get(record["username"], {}).values():
+            index.remove(record)
+        user_records = self._by_user.get(record["username"])
+        if user_records is not None:
+            user_records.pop(record["id"], None)
+            if not user_records:
+                del self._by_user[record["username"]]
+                self._derived.pop(record["username"], None)
+
+    # Индекс строится один раз по текущим записям пользователя, дальше его
+    # поддерживают _index/_unindex; при перечитывании с диска он сбрасывается
+    def _derived_index(self, username: str, name: str, factory):
+        derived = self._derived.setdefault(username, {})
+        index = derived.get(name)
+        if index is None:
+            index = derived[name] = factory(self._by_user.get(username, {}).values())
+        return index
+
+    # В режиме sharded перечитывается только хранилище пользователя, иначе — всё
+    def _reload(self, username: str):
+        if self.persister.lazy:
+            self._derived.pop(username, None)
+            for record in list(self._by_user.get(username, {}).values()):
+                self._unindex(record)
+            records, vaults = self.persister.load_user(username)
+            self._vaults.pop(username, None)
+            self._vaults.update(vaults)
+        else:
+            self._by_id.clear()
+            self._by_user.clear()
+            self._derived.clear()
+            records, self._vaults = self.persister.load()
+        for record in records:
+            self._index(record)
+
+    @contextmanager
+    def _synced(self, username: str, write: bool = False):
+        lock = self.persister.lock_for(username)
+        with (lock.exclusive() if write else lock.shared()):
+            if lock.stale:
+                with self._lock:
+                    if lock.stale:
+                        self._reload(username)
+                        lock.mark_synced()
+            yield lock
+
+    def max_id(self) -> int:
+        with self._lock:
+            return max(self._by_id, default=0)
+
+    def dump(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._by_id.values())
+
+    def dump_user(self, username: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._by_user.get(username, {}).values())
+
+    # Содержимое файла записей (см. load_records) — всё хранилище или один пользователь
+    def dump_data(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"vaults": dict(self._vaults), "records": list(self._by_id.values())}
+
+    def dump_user_data(self, username: str) -> Dict[str, Any]:
+        with self._lock:
+            vault = self._vaults.get(username)
+            return {
+                "vaults": {username: vault} if vault else {},
+                "records": list(self._by_user.get(username, {}).values()),
+            }
+
+    # Версия хранилища пользователя без синхронизации с диском — для вызова под блокировкой
+    def current_version(self, username: str) -> int:
+        return self._vaults.get(username, {}).get("version", 0)
+
+    def _bump_version(self, username: str) -> int:
+        version = self.current_version(username) + 1
+        self._vaults[username] = {**self._vaults.get(username, {}), "version": version}
+        return version
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        if self.persister.lazy:
+            return [r for username in self.persister.usernames() for r in self.list_for_user(username)]
+        with self._synced(""):
+            return self.dump()
+
+    # Записи не меняются на месте: при обновлении создаётся новый словарь,
+    # поэтому возвращённые наружу объекты можно безопасно читать без блокировки.
+    def get(self, username: str, record_id: int) -> Optional[Dict[str, Any]]:
+        with self._synced(username):
+            return self._by_user.get(username, {}).get(record_id)
+
+    def list_for_user(self, username: str) -> List[Dict[str, Any]]:
+        with self._synced(username):
+            return self.dump_user(username)
+
+    # Страница записей в порядке поля field, начиная после ключа after (см. app.indexes.sort_key)
+    def page(self, username: str, field: str, after: Optional[SortKey], limit: int,
+             descending: bool = False) -> List[Dict[str, Any]]:
+        with self._synced(username):
+            with self._lock:
+                order = self._derived_index(username, f"order:{field}", partial(SortedOrder, field))
+                user_records = self._by_user.get(username, {})
+                return [user_records[i] for i in order.page(after, limit, descending)]
+
+    # До limit записей по поисковому запросу, лучшие первыми (см. app.indexes.SearchIndex)
+    def search(self, username: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        with self._synced(username):
+            with self._lock:
+                index = self._derived_index(username, "search", SearchIndex)
+                user_records = self._by_user.get(username, {})
+                return [user_records[i] for _, i in index.search(query, limit)]
+
+    # Записи, адрес которых относится к регистрируемому домену domain (см. app.domains)
+    def by_domain(self, username: str, domain: str) -> List[Dict[str, Any]]:
+        with self._synced(username):
+            with self._lock:
+                index = self._derived_index(username, "domain", DomainIndex)
+                user_records = self._by_user.get(username, {})
+                return [user_records[i] for i in index.lookup(domain)]
+
+    # Версия хранилища пользователя: растёт при каждом изменении его записей
+    def version(self, username: str) -> int:
+        with self._synced(username):
+            return self.current_version(username)
+
+    # Изменения после версии since: (текущая версия, изменённые и новые записи, id удалённых).
+    # None — удаления после since уже забыты, клиенту нужна полная синхронизация.
+    # since=0 — все записи.
+    def changes(self, username: str, since: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[int]]]:
+        with self._synced(username):
+            with self._lock:
+                vault = self._vaults.get(username, {})
+                version = vault.get("version", 0)
+                if since > version or (since and since < vault.get("horizon", 0)):
+                    return None
+                order = self._derived_index(username, "versions", VersionOrder)
+                user_records = self._by_user.get(username, {})
+                changed = [user_records[i] for i in order.since(since)]
+                deleted = [record_id for v, record_id in vault.get("deleted", []) if v > since] if since else []
+                return version, changed, deleted
+
+    def count_for_user(self, username: str) -> int:
+        with self._synced(username):
+            return len(self._by_user.get(username, {}))
+
+    def create(self, username: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        now = datetime.utcnow().isoformat()
+        with self._synced(username, write=True) as lock:
+            with self._lock:
+                record = {
+                    "id": self.persister.allocate_id(self),
+                    "username": username,
+                    **fields,
+                    "created_at": now,
+                    "updated_at": now,
+                    "version": self._bump_version(username),
+                }
+                self._index(record)
+                lock.mark_dirty()
+                ticket = self.persister.put(self, record)
+            # данные должны оказаться на диске до того, как блокировка перейдёт другому процессу
+            self.persister.wait(ticket)
+        return record
+
+    def update(self, username: str, record_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._synced(username, write=True) as lock:
+            with self._lock:
+                old = self._by_user.get(username, {}).get(record_id)
+                if old is None:
+                    return None
+                record = {**old, **fields, "updated_at": datetime.utcnow().isoformat(),
+                          "version": self._bump_version(username)}
+                self._index(record)
+                lock.mark_dirty()
+                ticket = self.persister.put(self, record)
+            self.persister.wait(ticket)
+        return record
+
+    # Пакетная замена шифротекстов без изменения updated_at (перешифрование).
+    # swaps: id -> (ожидаемый, новый). Запись меняется, только если не менялась с момента
+    # чтения, иначе свежие данные пользователя не затираются. Возвращает id заменённых записей.
+    def swap_encrypted_passwords(self, username: str, swaps: Dict[int, Tuple[str, str]]) -> List[int]:
+        swapped: List[int] = []
+        tickets = []
+        with self._synced(username, write=True) as lock:
+            with self._lock:
+                user_records = self._by_user.get(username, {})
+                matched = []
+                for record_id, (expected, new) in swaps.items():
+                    old = user_records.get(record_id)
+                    if old is not None and old["encrypted_password"] == expected:
+                        matched.append((old, new))
+                if matched:
+                    # одна версия на весь пакет: она должна быть известна до постановки записей в очередь
+                    version = self._bump_version(username)
+                    lock.mark_dirty()
+                for old, new in matched:
+                    record = {**old, "encrypted_password": new, "version": version}
+                    self._index(record)
+                    tickets.append(self.persister.put(self, record))
+                    swapped.append(record["id"])
+            for ticket in tickets:
+                self.persister.wait(ticket)
+        return swapped
+
+    def delete(self, username: str, record_id: int) -> bool:
+        with self._synced(username, write=True) as lock:
+            with self._lock:
+                record = self._by_user.get(username, {}).get(record_id)
+                if record is None:
+                    return False
+                self._unindex(record)
+                version = self._bump_version(username)
+                self._vaults[username] = with_deletion(
+                    self._vaults[username], record_id, version, settings.sync_retention
+                )
+                lock.mark_dirty()
+                ticket = self.persister.delete(self, record)
+            self.persister.wait(ticket)
+        return True
+
 
-def save_records(records: List[Dict[str, Any]]):
-    with open(RECORDS_FILE, "w", encoding="utf-8") as f:
-        json.dump(records, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+records_store = RecordStore(_make_persister())
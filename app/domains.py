@@ -0,0 +1,107 @@
+import ipaddress
+from functools import lru_cache
+from typing import FrozenSet, Optional, Tuple
+from urllib.parse import urlsplit
+
+from app.config import settings
+
+# Разбор адресов записей для автозаполнения: имя хоста и регистрируемый домен
+# (домен, купленный владельцем сайта: login.example.co.uk -> example.co.uk).
+#
+# Публичные суффиксы из нескольких меток, под которыми регистрируют домены.
+# Встроенный список покрывает распространённые зоны и хостинги, где соседние
+# поддомены принадлежат разным владельцам. Полный Public Suffix List можно
+# подключить файлом (PM_PUBLIC_SUFFIX_FILE, формат public_suffix_list.dat).
+_BUILTIN_SUFFIXES = frozenset({
+    "co.uk", "org.uk", "me.uk", "ltd.uk", "plc.uk", "ac.uk", "gov.uk", "net.uk",
+    "com.au", "net.au", "org.au", "edu.au", "gov.au",
+    "co.nz", "org.nz", "net.nz", "co.za", "org.za",
+    "co.jp", "ne.jp", "or.jp", "ac.jp", "go.jp",
+    "co.kr", "or.kr", "co.in", "net.in", "org.in", "co.il", "org.il",
+    "com.br", "net.br", "org.br", "com.ar", "com.mx", "com.co", "com.pe",
+    "com.cn", "net.cn", "org.cn", "com.hk", "com.tw", "com.sg", "com.my",
+    "com.tr", "com.ua", "kiev.ua", "com.pl", "net.pl", "org.pl",
+    "com.ru", "net.ru", "org.ru", "msk.ru", "spb.ru", "com.by", "com.kz",
+    "github.io", "gitlab.io", "herokuapp.com", "appspot.com", "blogspot.com",
+    "cloudfront.net", "azurewebsites.net", "firebaseapp.com", "web.app",
+    "netlify.app", "vercel.app", "pages.dev", "workers.dev",
+})
+
+
+# Правила списка суффиксов: (обычные, "*.x" — все метки под x, "!a.x" — исключения)
+@lru_cache(maxsize=1)
+def _suffix_rules() -> Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str]]:
+    if not settings.public_suffix_file:
+        return _BUILTIN_SUFFIXES, frozenset(), frozenset()
+    rules, wildcards, exceptions = set(), set(), set()
+    with open(settings.public_suffix_file, "r", encoding="utf-8") as f:
+        for line in f:
+            rule = line.strip().lower()
+            if not rule or rule.startswith("//"):
+                continue
+            rule = _to_ascii(rule.split()[0].lstrip("!*."))
+            if line.lstrip().startswith("!"):
+                exceptions.add(rule)
+            elif line.lstrip().startswith("*."):
+                wildcards.add(rule)
+            else:
+                rules.add(rule)
+    return frozenset(rules), frozenset(wildcards), frozenset(exceptions)
+
+
+def _to_ascii(host: str) -> str:
+    try:
+        return host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return host
+
+
+# Имя хоста из адреса: нижний регистр, без порта и точки в конце, IDN — в punycode.
+# Адрес без схемы ("example.com/login") тоже разбирается. None — хоста нет.
+def url_host(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    url = url.strip()
+    if "://" not in url:
+        url = "//" + url
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    host = (host or "").rstrip(".")
+    # пробелы в имени — это не адрес, а произвольный текст в поле url
+    if not host or len(host.split()) != 1:
+        return None
+    return _to_ascii(host)
+
+
+# Регистрируемый домен хоста: одна метка плюс публичный суффикс.
+# IP-адреса, одиночные имена (localhost) и сами суффиксы возвращаются как есть.
+def registrable_domain(host: str) -> str:
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    labels = host.split(".")
+    if len(labels) < 2:
+        return host
+    rules, wildcards, exceptions = _suffix_rules()
+    suffix_len = 1
+    for i in range(len(labels) - 1):
+        candidate = ".".join(labels[i:])
+        if candidate in exceptions:
+            suffix_len = len(labels) - i - 1
+            break
+        if candidate in rules or ".".join(labels[i + 1:]) in wildcards:
+            suffix_len = len(labels) - i
+            break
+    if suffix_len >= len(labels):
+        return host
+    return ".".join(labels[-suffix_len - 1:])
+
+
+# (хост, регистрируемый домен) адреса или None
+def url_domain(url: Optional[str]) -> Optional[Tuple[str, str]]:
+    host = url_host(url)
+    return (host, registrable_domain(host)) if host else None
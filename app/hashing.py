@@ -0,0 +1,168 @@
+import asyncio
+import multiprocessing
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+from passlib.context import CryptContext
+
+from app.config import settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Целевая стоимость bcrypt. min = max = default, чтобы needs_update() считал
+# устаревшим любой хэш с другой стоимостью — и более слабый, и более дорогой.
+def configure_rounds(rounds: int):
+    pwd_context.update(
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+# Подбор стоимости под конкретный сервер: самая высокая стоимость,
+# при которой медиана хэширования укладывается в target_ms
+def calibrate(target_ms: float, min_rounds: int = 10, samples: int = 5, verbose: bool = False) -> int:
+    chosen = min_rounds
+    for rounds in range(min_rounds, 32):
+        context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds)
+        timings = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            context.hash("calibration-password")
+            timings.append((time.perf_counter() - started) * 1000)
+        median = statistics.median(timings)
+        if verbose:
+            print(f"  cost {rounds}: {median:.1f} мс")
+        if median > target_ms:
+            break
+        chosen = rounds
+    return chosen
+
+
+# Функции выполняются в дочерних процессах пула
+def _init_worker(rounds: int):
+    configure_rounds(rounds)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+# Отдельный пул процессов для bcrypt: хэширование не занимает GIL и потоки
+# веб-воркера. Очередь ограничена — при переполнении запрос сразу получает
+# отказ (503), а не ждёт, пока освободятся процессы.
+class HashingPool:
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = settings.bcrypt_rounds or 12
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._latencies = deque(maxlen=1000)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                        initargs=(self.rounds,),
+                    )
+        return self._executor
+
+    # Меняет стоимость в этом процессе и пересоздаёт пул, чтобы дочерние процессы получили её же
+    def configure(self, rounds: int):
+        self.rounds = rounds
+        configure_rounds(rounds)
+        self.shutdown()
+
+    def _submit(self, func, *args) -> Future:
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise HashQueueFull()
+            self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        future.add_done_callback(lambda f: self._done(started))
+        return future
+
+    def _done(self, started: float):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._latencies.append(time.perf_counter() - started)
+
+    async def hash(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(_hash, password))
+
+    # Возвращает (пароль верен, новый хэш или None, если перехэшировать не нужно)
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self._submit(_verify_and_update, password, hashed))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            in_flight = self._in_flight
+            completed, rejected = self._completed, self._rejected
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "workers": self.workers,
+            "bcrypt_rounds": self.rounds,
+            "in_flight": in_flight,
+            "queue_depth": max(0, in_flight - self.workers),
+            "queue_limit": self.max_queue,
+            "completed": completed,
+            "rejected": rejected,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p99": percentile(0.99),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(settings.hash_workers, settings.hash_queue_size)
+configure_rounds(hashing_pool.rounds)
+
+
+# Подбор стоимости bcrypt на этом сервере:
+#   python -m app.hashing calibrate
+if __name__ == "__main__":
+    if sys.argv[1:] == ["calibrate"]:
+        print(f"Бюджет: {settings.bcrypt_target_ms} мс на хэш")
+        rounds = calibrate(settings.bcrypt_target_ms, settings.bcrypt_min_rounds, verbose=True)
+        print(f"PM_BCRYPT_ROUNDS={rounds}")
+    else:
+        print("Использование: python -m app.hashing calibrate")
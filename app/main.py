@@ -1,19 +1,71 @@
-from fastapi import FastAPI, Request, Form, HTTPException, status, Depends
+from fastapi import FastAPI, Request, Form, HTTPException, status, Depends, Query
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 from app.auth import login_user, register_user, get_current_username, get_user_key
 import app.models
-from app.models import UserCreate, UserLogin
-from app.passwords import router as passwords_router, load_records
-from app.database import load_users
+from app.models import UserCreate, UserLogin, User
+from app.passwords import router as passwords_router
 from datetime import datetime
-from app.passwords import encrypt, get_all_records
-from app.database import save_records
-from app.middleware import AuthMiddleware
-
-app = FastAPI()
+from app.passwords import encrypt, get_all_records, upgrade_legacy_records, fetch_page, check_vault_etag, SortField, SortOrder
+from starlette.background import BackgroundTask
+from app.storage import storage
+from app.database import cache_stats, FileLock
+from app.crypto import cipher_cache
+from app.middleware import AuthMiddleware, set_session_cookie
+from app.sessions import session_tokens, session_store, SESSION_COOKIE, SESSION_ID_COOKIE
+from app.services import run_blocking, configure_thread_pool
+from app.hashing import hashing_pool, calibrate
+from app.config import settings
+from app.throttle import login_throttle, check_throttle, user_key
+from app.rotation import key_rotator
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import urlencode
+
+
+BCRYPT_ROUNDS_FILE = "venv/app/bcrypt.rounds"
+
+
+# Стоимость bcrypt для PM_BCRYPT_ROUNDS=0. Калибрует только первый воркер, остальные
+# ждут его под блокировкой файла и берут тот же результат: воркеры, которые калибруются
+# одновременно на общих ядрах, выбирают разную стоимость и на каждом входе
+# перехэшируют хэши друг друга. Чтобы подобрать стоимость заново, удалите файл.
+def shared_bcrypt_rounds() -> int:
+    with FileLock(BCRYPT_ROUNDS_FILE).exclusive():
+        try:
+            with open(BCRYPT_ROUNDS_FILE, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            pass
+        rounds = calibrate(settings.bcrypt_target_ms, settings.bcrypt_min_rounds)
+        with open(BCRYPT_ROUNDS_FILE, "w", encoding="utf-8") as f:
+            f.write(str(rounds))
+            f.flush()
+            os.fsync(f.fileno())
+        return rounds
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_thread_pool()
+    if settings.bcrypt_rounds == 0:
+        hashing_pool.configure(await run_blocking(shared_bcrypt_rounds))
+    await key_rotator.resume_pending()
+    reaper = None
+    if settings.session_mode == "server":
+        reaper = asyncio.create_task(session_store.reap_forever(settings.session_reap_interval))
+    yield
+    if reaper is not None:
+        reaper.cancel()
+    await key_rotator.shutdown()
+    hashing_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(AuthMiddleware)
 app.mount("/static", StaticFiles(directory="venv/app/static"), name="static")
 templates = Jinja2Templates(directory="venv/app/templates")
@@ -21,6 +73,17 @@ templates = Jinja2Templates(directory="venv/app/templates")
 app.include_router(passwords_router)
 
 
+# Начало сессии: подписанный токен, идентификатор сессии на сервере
+# или (в режиме cookie) имя пользователя
+def _start_session(response, user: User):
+    if settings.session_mode == "token":
+        set_session_cookie(response, session_tokens.issue(user))
+    elif settings.session_mode == "server":
+        response.set_cookie(SESSION_ID_COOKIE, session_store.create(user), httponly=True, samesite="lax")
+    else:
+        response.set_cookie(key="X-Username", value=user.username, httponly=True, max_age=86400)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def show_login(request: Request):
     return templates.TemplateResponse("login.html", {"request": request, "error": None})
@@ -31,40 +94,99 @@ async def process_login(
     username: str = Form(...),
     password: str = Form(...)
 ):
+    client = request.client.host if request.client else "unknown"
+    # адрес первым: клиент, уже упёршийся в лимит, отклоняется, не заводя ключей по именам
+    keys = (f"ip:{client}", user_key(username))
     try:
-        result = login_user(UserLogin(username=username, password=password))
+        # лимит проверяется до bcrypt, чтобы перебор не расходовал процессор
+        check_throttle(*keys)
+        try:
+            result = await login_user(UserLogin(username=username, password=password))
+        except HTTPException as e:
+            if e.status_code == 401:
+                login_throttle.failure(*keys)
+            raise
+        login_throttle.success(keys[1])
         response = RedirectResponse(url="/passwords", status_code=303)
-        response.set_cookie(key="X-Username", value=username, httponly=True)
+        response.background = BackgroundTask(upgrade_legacy_records, username, result["user_key"])
+        _start_session(response, result["user"])
         return response
     except HTTPException as e:
         return templates.TemplateResponse(
             "login.html",
             {"request": request, "error": e.detail},
-            status_code=e.status_code
+            status_code=e.status_code,
+            headers=e.headers
         )
 
 
 @app.get("/passwords", response_class=HTMLResponse)
-async def show_passwords(request: Request):
+async def show_passwords(
+    request: Request,
+    limit: int = Query(settings.page_size, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = None,
+    sort: SortField = "created_at",
+    order: SortOrder = "asc",
+    q: Optional[str] = Query(None, max_length=200),
+):
     username = request.state.username
 
-    records = load_records()
-    user_records = [r for r in records if r["username"] == username]
-
-    return templates.TemplateResponse(
+    cache_headers, not_modified = await run_blocking(check_vault_etag, request, username)
+    if not_modified:
+        return not_modified
+
+    next_url = None
+    if q and q.strip():
+        user_records = await run_blocking(storage.search_records, username, q, settings.search_limit)
+        next_cursor = None
+    else:
+        q = None
+        user_records, next_cursor = await run_blocking(fetch_page, username, limit, cursor, sort, order)
+    if next_cursor:
+        next_url = "/passwords?" + urlencode({"limit": limit, "sort": sort, "order": order, "cursor": next_cursor})
+
+    response = templates.TemplateResponse(
         "passwords.html",
         {
             "request": request,
             "username": username,
-            "records": user_records
+            "records": user_records,
+            "sort": sort,
+            "order": order,
+            "next_url": next_url,
+            "q": q,
         }
     )
+    response.headers.update(cache_headers)
+    return response
+
+
+# Метрики для мониторинга (доступны без авторизации)
+@app.get("/metrics")
+def metrics():
+    return {
+        "read_cache": cache_stats(),
+        "hashing": hashing_pool.metrics(),
+        "login_throttle_keys": len(login_throttle),
+        "cipher_cache": cipher_cache.stats(),
+        "sessions": session_tokens.stats(),
+        "session_store": session_store.stats(),
+    }
 
 
 @app.get("/logout")
-async def logout():
+async def logout(request: Request):
+    token = request.cookies.get(SESSION_COOKIE)
+    claims = session_tokens.verify(token) if token else None
+    if claims is not None:
+        session_tokens.revoke(claims)
+    sid = request.cookies.get(SESSION_ID_COOKIE)
+    if sid:
+        session_store.delete(sid)
     response = RedirectResponse(url="/")
     response.delete_cookie("X-Username")
+    response.delete_cookie(SESSION_COOKIE)
+    response.delete_cookie(SESSION_ID_COOKIE)
     return response
 
 @app.get("/register", response_class=HTMLResponse)
@@ -73,22 +195,24 @@ def show_register(request: Request):
 
 
 @app.post("/register", response_class=HTMLResponse)
-def process_register(
+async def process_register(
     request: Request,
     username: str = Form(...),
     password: str = Form(...)
 ):
+    client = request.client.host if request.client else "unknown"
     try:
-        register_user(UserCreate(username=username, password=password))
+        check_throttle(f"register:{client}")
+        result = await register_user(UserCreate(username=username, password=password))
         # сразу логиним после успешной регистрации
         response = RedirectResponse(url="/passwords", status_code=303)
-        response.set_cookie(key="X-Username", value=username, httponly=True, max_age=86400)
+        _start_session(response, result["user"])
         return response
     except HTTPException as e:
         return templates.TemplateResponse("register.html", {
             "request": request,
             "error": e.detail
-        }, status_code=e.status_code)
+        }, status_code=e.status_code, headers=e.headers)
 
 
 if __name__ == "__main__":
@@ -1,36 +1,132 @@
-from fastapi import Request, HTTPException, status
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response, RedirectResponse
-from app.database import load_users
-from app.auth import get_user_key
-
-
-class AuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        
-        path = request.url.path
-
-        # Публичные маршруты — пропускаем без проверки
-        if path in {"/", "/login", "/register", "/logout"} or \
-           path.startswith("/static/") or \
-           path.startswith("/docs") or \
-           path.startswith("/openapi.json") or \
-           path == "/favicon.ico":
-            return await call_next(request)
-
-        # Дальше — только авторизованные запросы
-        username = request.cookies.get("X-Username")
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+from starlette.responses import RedirectResponse, Response
+from app.config import settings
+from app.sessions import session_tokens, session_store, session_id, SESSION_COOKIE, SESSION_ID_COOKIE
+from app.auth import request_user_cache, resolve_user_async
+
+# Публичные маршруты — пропускаем без проверки.
+# Точные пути проверяются по множеству, префиксы — одним вызовом str.startswith.
+PUBLIC_PATHS = frozenset({"/", "/login", "/register", "/logout", "/metrics", "/favicon.ico"})
+PUBLIC_PREFIXES = ("/static/", "/docs", "/openapi.json")
+
+
+def is_public(path: str) -> bool:
+    return path in PUBLIC_PATHS or path.startswith(PUBLIC_PREFIXES)
+
+
+def _cookie(scope, name: str):
+    for key, value in scope["headers"]:
+        if key == b"cookie":
+            return cookie_parser(value.decode("latin-1")).get(name)
+    return None
+
+
+def set_session_cookie(response: Response, token: str):
+    response.set_cookie(
+        SESSION_COOKIE, token, max_age=int(settings.session_ttl), httponly=True, samesite="lax"
+    )
+
+
+# Добавляет Set-Cookie с новым токеном к ответу приложения
+def _with_cookie(send, token: str):
+    cookie = Response()
+    set_session_cookie(cookie, token)
+    cookie_header = cookie.headers["set-cookie"]
+
+    async def send_wrapper(message):
+        if message["type"] == "http.response.start":
+            MutableHeaders(scope=message).append("set-cookie", cookie_header)
+        await send(message)
+    return send_wrapper
+
+
+# Чистый ASGI-middleware: без обёрток BaseHTTPMiddleware над задачами и потоками тела.
+# Пользователь ищется в словаре по имени, который перестраивается только при изменении
+# users.json; пока словарь актуален, поиск идёт прямо в цикле событий, без перехода в пул потоков.
+class AuthMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or is_public(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        with request_user_cache():
+            await self._authenticate(scope, receive, send)
+
+    # Дальше — только авторизованные запросы
+    async def _authenticate(self, scope, receive, send):
+        if settings.session_mode == "token":
+            await self._token_session(scope, receive, send)
+            return
+        if settings.session_mode == "server":
+            await self._server_session(scope, receive, send)
+            return
+
+        username = _cookie(scope, "X-Username")
         if not username:
-            return RedirectResponse(url="/", status_code=303)
+            await RedirectResponse(url="/", status_code=303)(scope, receive, send)
+            return
 
-        users = load_users()
-        user = next((u for u in users if u.username == username), None)
+        user = await resolve_user_async(username)
         if not user:
-            response = RedirectResponse(url="/", status_code=303)
-            response.delete_cookie("X-Username")
-            return response
+            await self._reject(scope, receive, send, "X-Username")
+            return
+
+        self._set_state(scope, username, user.encrypted_user_key, user.previous_user_key)
+        await self.app(scope, receive, send)
+
+    # Подписанный токен: подпись и срок проверяются без хранилища, ключ шифрования
+    # берётся из памяти по дескриптору kh; хранилище читается только при промахе.
+    async def _token_session(self, scope, receive, send):
+        token = _cookie(scope, SESSION_COOKIE)
+        claims = session_tokens.verify(token) if token else None
+        if claims is None:
+            await self._reject(scope, receive, send, SESSION_COOKIE)
+            return
+
+        username = claims["sub"]
+        keys = session_tokens.keys_for(username, claims["kh"])
+        refresh = session_tokens.needs_refresh(claims)
+        if keys is None or refresh:
+            user = await resolve_user_async(username)
+            if not user:
+                await self._reject(scope, receive, send, SESSION_COOKIE)
+                return
+            keys = (user.encrypted_user_key, user.previous_user_key)
+            # новый токен — во второй половине срока и после смены ключа (kh изменился);
+            # старый не отзывается, чтобы параллельные запросы с ним не получили отказ,
+            # а sid у них общий — выход отзовёт оба
+            if refresh or session_tokens.remember(user) != claims["kh"]:
+                send = _with_cookie(send, session_tokens.issue(user, session_id(claims)))
+
+        state = self._set_state(scope, username, *keys)
+        state["session"] = claims
+        await self.app(scope, receive, send)
+
+    # Сессия на сервере: один поиск в словаре, без хранилища и проверки подписи
+    async def _server_session(self, scope, receive, send):
+        sid = _cookie(scope, SESSION_ID_COOKIE)
+        session = session_store.get(sid) if sid else None
+        if session is None:
+            await self._reject(scope, receive, send, SESSION_ID_COOKIE)
+            return
+        state = self._set_state(scope, session.username, session.user_key, session.previous_user_key)
+        state["session_id"] = sid
+        await self.app(scope, receive, send)
 
-        request.state.username = username
-        request.state.user_key = user.encrypted_user_key
+    @staticmethod
+    def _set_state(scope, username: str, user_key: str, previous_user_key):
+        state = scope.setdefault("state", {})
+        state["username"] = username
+        state["user_key"] = user_key
+        state["previous_user_key"] = previous_user_key
+        return state
 
-        return await call_next(request)
\ No newline at end of file
+    @staticmethod
+    async def _reject(scope, receive, send, cookie: str):
+        response = RedirectResponse(url="/", status_code=303)
+        response.delete_cookie(cookie)
+        await response(scope, receive, send)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 
 class UserCreate(BaseModel):
@@ -14,6 +14,8 @@ class User(BaseModel):
     username: str
     hashed_password: str
     encrypted_user_key: str
+    # Прежний ключ на время смены ключа: записи читаются новым, затем старым
+    previous_user_key: Optional[str] = None
 
 # Модели для записей паролей
 class PasswordRecordCreate(BaseModel):
@@ -36,4 +38,16 @@ class PasswordRecordOut(BaseModel):
     login: str
     encrypted_password: str
     url: Optional[str] = None
-    notes: Optional[str] = None
\ No newline at end of file
+    notes: Optional[str] = None
+
+# Результат поиска по адресу сайта: "host" — тот же хост, "domain" — тот же регистрируемый домен
+class PasswordRecordMatch(PasswordRecordOut):
+    match: Literal["host", "domain"]
+
+# Изменения после версии клиента (since). full_resync — клиент отстал сильнее, чем хранятся
+# удаления: нужно заново получить всё (since=0) и продолжать с присланной version
+class PasswordSyncOut(BaseModel):
+    version: int
+    full_resync: bool = False
+    changed: List[PasswordRecordOut] = []
+    deleted: List[int] = []
@@ -1,30 +1,43 @@
-from fastapi import APIRouter, Request, HTTPException
-from typing import List
-from cryptography.fernet import Fernet, InvalidToken
+import base64
+import hashlib
+import json
+from fastapi import APIRouter, Request, HTTPException, Query, Response
+from typing import Dict, Any, List, Literal, Optional, Tuple
 from datetime import datetime
-from base64 import urlsafe_b64decode
 from fastapi import Form
 
 from app.models import (
     PasswordRecordCreate,
     PasswordRecordUpdate,
-    PasswordRecordOut
+    PasswordRecordOut,
+    PasswordRecordMatch,
+    PasswordSyncOut,
 )
-from app.database import load_records, save_records
+from app.storage import storage
+from app.services import run_blocking
+from app.crypto import encrypt, decrypt, encrypt_many, decrypt_many, needs_upgrade, upgrade
+from app.rotation import key_rotator, KeyRotationInProgress
+from app.config import settings
+from app.domains import url_domain
 
 router = APIRouter(prefix="/passwords")
 
 
-def encrypt(plain: str, key_b64: str) -> str:
-    key_bytes = urlsafe_b64decode(key_b64)    
-    f = Fernet(key_bytes)
-    return f.encrypt(plain.encode()).decode()
-
-
-def decrypt(enc: str, key_b64: str) -> str:
-    key_bytes = urlsafe_b64decode(key_b64)
-    f = Fernet(key_bytes)
-    return f.decrypt(enc.encode()).decode()
+# Фоновый проход после входа: перешифровывает записи пользователя,
+# сохранённые в устаревшем формате. Записи, изменённые за это время, не трогаются.
+def upgrade_legacy_records(username: str, key_b64: str) -> int:
+    legacy = [r for r in storage.list_records(username) if needs_upgrade(r["encrypted_password"])]
+    if not legacy:
+        return 0
+    plains = decrypt_many([r["encrypted_password"] for r in legacy], key_b64)
+    readable = [(r, p) for r, p in zip(legacy, plains) if not isinstance(p, Exception)]
+    new_encs = encrypt_many([p for _, p in readable], key_b64)
+    swaps = {
+        record["id"]: (record["encrypted_password"], new_enc)
+        for (record, _), new_enc in zip(readable, new_encs)
+        if not isinstance(new_enc, Exception)
+    }
+    return len(storage.swap_encrypted_passwords(username, swaps)) if swaps else 0
 
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
@@ -51,35 +64,100 @@ async def create_record(
     username = request.state.username
     key_b64 = request.state.user_key
 
-    encrypted_pwd = encrypt(password, key_b64)
-
-    records = load_records()
-    new_id = max((r["id"] for r in records), default=0) + 1
+    encrypted_pwd = await run_blocking(encrypt, password, key_b64)
 
-    new_record = {
-        "id": new_id,
-        "username": username,
+    await run_blocking(storage.create_record, username, {
         "title": title,
         "login": login,
         "encrypted_password": encrypted_pwd,
         "url": url,
         "notes": notes,
-        "created_at": datetime.utcnow().isoformat(),
-        "updated_at": datetime.utcnow().isoformat(),
-    }
-
-    records.append(new_record)
-    save_records(records)
+    })
     # После успешного сохранения — редирект на список
     return RedirectResponse(url="/passwords", status_code=303)
 
 
+# Условный GET по версии хранилища пользователя (storage.vault_version).
+# ETag включает хэш имени: иначе после входа под другим пользователем браузер
+# получил бы 304 и показал список предыдущего. Версия читается раньше записей,
+# поэтому отданные данные никогда не старше своего ETag.
+def vault_etag(username: str, version: int) -> str:
+    return f'"{version}-{hashlib.sha256(username.encode()).hexdigest()[:12]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+# Заголовки кэширования и готовый ответ 304, если у клиента актуальная версия (иначе None)
+def check_vault_etag(request: Request, username: str) -> Tuple[Dict[str, str], Optional[Response]]:
+    etag = vault_etag(username, storage.vault_version(username))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Cookie"}
+    if etag_matches(request, etag):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+SortField = Literal["title", "created_at", "updated_at"]
+SortOrder = Literal["asc", "desc"]
+
+
+# Курсор keyset-пагинации: base64url от JSON [поле, порядок, значение поля, id]
+# последней записи страницы. Следующая страница начинается строго после неё,
+# поэтому вставки и удаления между запросами не сдвигают страницы.
+def encode_cursor(record: Dict[str, Any], sort: str, order: str) -> str:
+    raw = json.dumps([sort, order, record.get(sort), record["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, sort: str, order: str) -> Tuple[Optional[str], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, record_id = json.loads(raw)
+        valid = (cursor_sort, cursor_order) == (sort, order) and isinstance(record_id, int) \
+            and (value is None or isinstance(value, str))
+    except (ValueError, TypeError):
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+    return value, record_id
+
+
+# Одна страница записей и курсор следующей (None — страница последняя)
+def fetch_page(username: str, limit: int, cursor: Optional[str], sort: str,
+               order: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    after = decode_cursor(cursor, sort, order) if cursor else None
+    records = storage.list_records_page(username, sort, after, limit + 1, order == "desc")
+    if len(records) <= limit:
+        return records, None
+    records = records[:limit]
+    return records, encode_cursor(records[-1], sort, order)
+
+
 @router.get("/", response_model=List[PasswordRecordOut])
-def get_all_records(request: Request):
+def get_all_records(
+    request: Request,
+    response: Response,
+    limit: int = Query(settings.page_size, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = None,
+    sort: SortField = "created_at",
+    order: SortOrder = "asc",
+):
     username = request.state.username
 
-    records = load_records()
-    user_records = [r for r in records if r["username"] == username]
+    cache_headers, not_modified = check_vault_etag(request, username)
+    if not_modified:
+        return not_modified
+    response.headers.update(cache_headers)
+
+    user_records, next_cursor = fetch_page(username, limit, cursor, sort, order)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     return [
         PasswordRecordOut(
@@ -94,27 +172,135 @@ def get_all_records(request: Request):
     ]
 
 
+# Поиск по названию, логину и адресу; лучшие совпадения первыми.
+# Объявлен до /{record_id} по той же причине, что и rotate-key ниже.
+@router.get("/search", response_model=List[PasswordRecordOut])
+def search_records(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(settings.search_limit, ge=1, le=settings.search_limit_max),
+):
+    username = request.state.username
+
+    cache_headers, not_modified = check_vault_etag(request, username)
+    if not_modified:
+        return not_modified
+    response.headers.update(cache_headers)
+
+    return [
+        PasswordRecordOut(
+            id=r["id"],
+            title=r["title"],
+            login=r["login"],
+            encrypted_password=r["encrypted_password"],
+            url=r.get("url"),
+            notes=r.get("notes"),
+        )
+        for r in storage.search_records(username, q, limit)
+    ]
+
+
+# Записи для автозаполнения на странице url: сначала с тем же хостом,
+# затем с другими хостами того же регистрируемого домена (login.example.co.uk ~ example.co.uk).
+@router.get("/lookup", response_model=List[PasswordRecordMatch])
+def lookup_records(request: Request, response: Response, url: str = Query(..., min_length=1, max_length=2048)):
+    username = request.state.username
+
+    parsed = url_domain(url)
+    if parsed is None:
+        raise HTTPException(status_code=400, detail="Неверный адрес")
+    host, domain = parsed
+
+    cache_headers, not_modified = check_vault_etag(request, username)
+    if not_modified:
+        return not_modified
+    response.headers.update(cache_headers)
+
+    matches = []
+    for r in storage.find_records_by_domain(username, domain):
+        record_host = url_domain(r.get("url"))
+        matches.append(PasswordRecordMatch(
+            id=r["id"],
+            title=r["title"],
+            login=r["login"],
+            encrypted_password=r["encrypted_password"],
+            url=r.get("url"),
+            notes=r.get("notes"),
+            match="host" if record_host and record_host[0] == host else "domain",
+        ))
+    matches.sort(key=lambda m: m.match != "host")
+    return matches
+
+
+# Синхронизация между устройствами: новые и изменённые записи после версии since
+# и id удалённых. Клиент сохраняет присланную version и передаёт её в следующий раз.
+@router.get("/sync", response_model=PasswordSyncOut)
+def sync_records(request: Request, response: Response, since: int = Query(0, ge=0)):
+    username = request.state.username
+
+    cache_headers, not_modified = check_vault_etag(request, username)
+    if not_modified:
+        return not_modified
+    response.headers.update(cache_headers)
+
+    changes = storage.record_changes(username, since)
+    if changes is None:
+        return PasswordSyncOut(version=storage.vault_version(username), full_resync=True)
+    version, changed, deleted = changes
+    return PasswordSyncOut(
+        version=version,
+        changed=[
+            PasswordRecordOut(
+                id=r["id"],
+                title=r["title"],
+                login=r["login"],
+                encrypted_password=r["encrypted_password"],
+                url=r.get("url"),
+                notes=r.get("notes"),
+            )
+            for r in changed
+        ],
+        deleted=deleted,
+    )
+
+
+# Смена ключа шифрования: запуск и ход выполнения.
+# Маршруты объявлены до /{record_id}, иначе "rotate-key" разбирался бы как id записи.
+@router.post("/rotate-key", status_code=202)
+async def start_key_rotation(request: Request):
+    try:
+        return await key_rotator.start(request.state.username)
+    except KeyRotationInProgress:
+        raise HTTPException(status_code=409, detail="Смена ключа уже выполняется")
+
+
+@router.get("/rotate-key")
+def key_rotation_progress(request: Request):
+    return key_rotator.progress(request.state.username)
+
+
 @router.get("/{record_id}", response_class=HTMLResponse)
 async def view_record(record_id: int, request: Request):
     username = request.state.username
     key_b64 = request.state.user_key
 
-    records = load_records()
-    record = next(
-        (r for r in records if r["id"] == record_id and r["username"] == username),
-        None
-    )
+    record = await run_blocking(storage.get_record, username, record_id)
 
     if not record:
         raise HTTPException(status_code=404, detail="Запись не найдена или не принадлежит вам")
 
     # Расшифровываем пароль только для отображения
     try:
-        decrypted_password = decrypt(record["encrypted_password"], key_b64)
+        decrypted_password = await run_blocking(
+            decrypt, record["encrypted_password"], key_b64, request.state.previous_user_key
+        )
     except Exception as e:
         decrypted_password = "[Ошибка расшифровки]"
 
-    return templates.TemplateResponse(
+    # На странице пароль в открытом виде: ни браузер, ни прокси не должны её сохранять,
+    # поэтому здесь нет ETag (ответ 304 требует сохранённой копии)
+    response = templates.TemplateResponse(
         "view.html",
         {
             "request": request,
@@ -131,16 +317,14 @@ async def view_record(record_id: int, request: Request):
             }
         }
     )
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 @router.get("/{record_id}/delete", response_class=HTMLResponse)
 async def confirm_delete_page(record_id: int, request: Request):
     username = request.state.username
 
-    records = load_records()
-    record = next(
-        (r for r in records if r["id"] == record_id and r["username"] == username),
-        None
-    )
+    record = await run_blocking(storage.get_record, username, record_id)
 
     if not record:
         raise HTTPException(status_code=404, detail="Запись не найдена")
@@ -167,17 +351,15 @@ async def edit_record_form(record_id: int, request: Request):
     username = request.state.username
     key_b64 = request.state.user_key
 
-    records = load_records()
-    record = next(
-        (r for r in records if r["id"] == record_id and r["username"] == username),
-        None
-    )
+    record = await run_blocking(storage.get_record, username, record_id)
 
     if not record:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
     try:
-        decrypted_password = decrypt(record["encrypted_password"], key_b64)
+        decrypted_password = await run_blocking(
+            decrypt, record["encrypted_password"], key_b64, request.state.previous_user_key
+        )
     except Exception:
         decrypted_password = ""
 
@@ -212,27 +394,20 @@ async def update_record(
     username = request.state.username
     key_b64 = request.state.user_key
 
-    records = load_records()
-    idx = next(
-        (i for i, r in enumerate(records) if r["id"] == record_id and r["username"] == username),
-        None
-    )
-
-    if idx is None:
+    if await run_blocking(storage.get_record, username, record_id) is None:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
-    encrypted_pwd = encrypt(password, key_b64)
+    encrypted_pwd = await run_blocking(encrypt, password, key_b64)
 
-    records[idx].update({
+    record = await run_blocking(storage.update_record, username, record_id, {
         "title": title,
         "login": login,
         "encrypted_password": encrypted_pwd,
         "url": url,
         "notes": notes,
-        "updated_at": datetime.utcnow().isoformat(),
     })
-
-    save_records(records)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Запись не найдена")
 
     return RedirectResponse(url="/passwords", status_code=303)
 
@@ -245,35 +420,28 @@ def update_full_record(
     username = request.state.username
     key_b64   = request.state.user_key
 
-    records = load_records()
-    idx = next(
-        (i for i, r in enumerate(records) if r["id"] == record_id and r["username"] == username),
-        None
-    )
-
-    if idx is None:
+    if storage.get_record(username, record_id) is None:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
     encrypted_pwd = encrypt(data.password, key_b64)
 
-    records[idx].update({
+    record = storage.update_record(username, record_id, {
         "title": data.title,
         "login": data.login,
         "encrypted_password": encrypted_pwd,
         "url": data.url,
         "notes": data.notes,
-        "updated_at": datetime.utcnow().isoformat(),
     })
-
-    save_records(records)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Запись не найдена")
 
     return PasswordRecordOut(
-        id=records[idx]["id"],
-        title=records[idx]["title"],
-        login=records[idx]["login"],
-        encrypted_password=records[idx]["encrypted_password"],
-        url=records[idx].get("url"),
-        notes=records[idx].get("notes"),
+        id=record["id"],
+        title=record["title"],
+        login=record["login"],
+        encrypted_password=record["encrypted_password"],
+        url=record.get("url"),
+        notes=record.get("notes"),
     )
 
 
@@ -286,31 +454,31 @@ def update_partial_record(
     username = request.state.username
     key_b64   = request.state.user_key
 
-    records = load_records()
-    idx = next(
-        (i for i, r in enumerate(records) if r["id"] == record_id and r["username"] == username),
-        None
-    )
-
-    if idx is None:
+    existing = storage.get_record(username, record_id)
+    if existing is None:
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
-    rec = records[idx]
-
+    changes = {}
     if data.password is not None:
-        rec["encrypted_password"] = encrypt(data.password, key_b64)
+        changes["encrypted_password"] = encrypt(data.password, key_b64)
+    elif needs_upgrade(existing["encrypted_password"]):
+        # пароль не меняется, но запись всё равно переписывается — заодно переводим её в новый формат
+        try:
+            changes["encrypted_password"] = upgrade(existing["encrypted_password"], key_b64)
+        except Exception:
+            pass
     if data.title is not None:
-        rec["title"] = data.title
+        changes["title"] = data.title
     if data.login is not None:
-        rec["login"] = data.login
+        changes["login"] = data.login
     if data.url is not None:
-        rec["url"] = data.url
+        changes["url"] = data.url
     if data.notes is not None:
-        rec["notes"] = data.notes
+        changes["notes"] = data.notes
 
-    rec["updated_at"] = datetime.utcnow().isoformat()
-
-    save_records(records)
+    rec = storage.update_record(username, record_id, changes)
+    if rec is None:
+        raise HTTPException(status_code=404, detail="Запись не найдена")
 
     return PasswordRecordOut(
         id=rec["id"],
@@ -325,18 +493,9 @@ def update_partial_record(
 async def delete_record_post(record_id: int, request: Request):
     username = request.state.username
 
-    records = load_records()
-    idx = next(
-        (i for i, r in enumerate(records) if r["id"] == record_id and r["username"] == username),
-        None
-    )
-
-    if idx is None:
+    if not await run_blocking(storage.delete_record, username, record_id):
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
-    del records[idx]
-    save_records(records)
-
     return RedirectResponse(url="/passwords", status_code=303)
 
 
@@ -344,23 +503,12 @@ async def delete_record_post(record_id: int, request: Request):
 def delete_record(record_id: int, request: Request):
     username = request.state.username
 
-    records = load_records()
-    idx = next(
-        (i for i, r in enumerate(records) if r["id"] == record_id and r["username"] == username),
-        None
-    )
-
-    if idx is None:
+    if not storage.delete_record(username, record_id):
         raise HTTPException(status_code=404, detail="Запись не найдена")
-
-    del records[idx]
-    save_records(records)
     return None
 
 
 @router.get("/stats")
 def get_stats(request: Request):
     username = request.state.username
-    records = load_records()
-    user_records = [r for r in records if r["username"] == username]
-    return {"total": len(user_records)}
\ No newline at end of file
+    return {"total": storage.count_records(username)}
\ No newline at end of file
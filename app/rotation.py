@@ -0,0 +1,147 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Tuple
+
+from app.config import settings
+from app.crypto import cipher_cache, generate_user_key
+from app.services import run_blocking, thread_pool_busy
+from app.sessions import session_tokens, session_store
+from app.storage import storage
+
+
+class KeyRotationInProgress(Exception):
+    pass
+
+
+# Онлайн-смена ключа пользователя (по образцу MultiFernet: читаем старым, пишем новым).
+# start() сразу записывает новый ключ, а старый сохраняет в previous_user_key:
+# новые и изменённые записи шифруются новым ключом, чтение пробует оба.
+# Фоновая задача небольшими пакетами перешифровывает оставшиеся записи через
+# swap_encrypted_password (правки пользователя не затираются) и в конце удаляет старый ключ.
+# Пока previous_user_key задан, смена считается незавершённой и возобновляется при старте.
+class KeyRotator:
+    def __init__(self, batch_size: int, pause: float, grace: float):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.grace = grace
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def progress(self, username: str) -> Dict[str, Any]:
+        job = self._jobs.get(username)
+        return dict(job) if job else {"state": "idle"}
+
+    async def start(self, username: str) -> Dict[str, Any]:
+        user = await run_blocking(storage.get_user, username)
+        if user is None or user.previous_user_key:
+            raise KeyRotationInProgress(username)
+        updated = await run_blocking(
+            storage.update_user_fields, username,
+            {"encrypted_user_key": generate_user_key(), "previous_user_key": user.encrypted_user_key},
+            {"encrypted_user_key": user.encrypted_user_key, "previous_user_key": None},
+        )
+        if updated is None:
+            raise KeyRotationInProgress(username)
+        session_tokens.forget(username)
+        session_store.update_user(updated)
+        self._launch(username)
+        return self.progress(username)
+
+    async def resume_pending(self):
+        for username in await run_blocking(storage.list_rotating_users):
+            self._launch(username)
+
+    async def shutdown(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def _launch(self, username: str):
+        task = self._tasks.get(username)
+        if task is not None and not task.done():
+            return
+        self._jobs[username] = {
+            "state": "running", "total": 0, "processed": 0,
+            "rotated": 0, "failed": 0, "started_at": time.time(),
+        }
+        self._tasks[username] = asyncio.create_task(self._run(username))
+
+    async def _run(self, username: str):
+        job = self._jobs[username]
+        try:
+            # запросы, успевшие прочитать старый ключ, должны завершиться до обхода,
+            # а другие процессы — перестать брать его из кэша сессий
+            await asyncio.sleep(max(self.grace, session_tokens.key_ttl))
+            user = await run_blocking(storage.get_user, username)
+            if user is None or not user.previous_user_key:
+                job["state"] = "done"
+                return
+            new_key, old_key = user.encrypted_user_key, user.previous_user_key
+            ids = [r["id"] for r in await run_blocking(storage.list_records, username)]
+            job["total"] = len(ids)
+            for i in range(0, len(ids), self.batch_size):
+                batch = ids[i:i + self.batch_size]
+                rotated, failed = await run_blocking(_rotate_batch, username, batch, new_key, old_key)
+                job["processed"] += len(batch)
+                job["rotated"] += rotated
+                job["failed"] += failed
+                await self._yield_to_requests()
+            finished = await run_blocking(
+                storage.update_user_fields, username,
+                {"previous_user_key": None}, {"previous_user_key": old_key},
+            )
+            cipher_cache.invalidate(old_key)
+            session_tokens.forget(username)
+            if finished is not None:
+                session_store.update_user(finished)
+            job["state"] = "done"
+        except asyncio.CancelledError:
+            job["state"] = "interrupted"
+            raise
+        except Exception as e:
+            # старый ключ остаётся в previous_user_key — смена продолжится при следующем старте
+            job["state"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = time.time()
+
+    async def _yield_to_requests(self):
+        await asyncio.sleep(self.pause)
+        while thread_pool_busy():
+            await asyncio.sleep(self.pause)
+
+
+# Перешифровывает пакет записей; возвращает (перешифровано, не удалось прочитать)
+def _rotate_batch(username: str, ids: List[int], new_key: str, old_key: str) -> Tuple[int, int]:
+    new, old = cipher_cache.get(new_key), cipher_cache.get(old_key)
+    rotated = failed = 0
+    pending = list(ids)
+    # повтор для записей, изменённых между чтением и заменой
+    for _ in range(3):
+        swaps = {}
+        for record_id in pending:
+            record = storage.get_record(username, record_id)
+            if record is None:
+                continue
+            enc = record["encrypted_password"]
+            try:
+                new.decrypt(enc)
+                continue
+            except Exception:
+                pass
+            try:
+                plain = old.decrypt(enc)
+            except Exception:
+                failed += 1
+                continue
+            swaps[record_id] = (enc, new.encrypt(plain))
+        if not swaps:
+            break
+        swapped = set(storage.swap_encrypted_passwords(username, swaps))
+        rotated += len(swapped)
+        pending = [record_id for record_id in swaps if record_id not in swapped]
+    return rotated, failed
+
+
+key_rotator = KeyRotator(settings.key_rotation_batch, settings.key_rotation_pause, settings.key_rotation_grace)
@@ -0,0 +1,22 @@
+from functools import partial
+
+from anyio import to_thread
+
+from app.config import settings
+
+
+# Блокирующие операции (чтение/запись хранилища, шифрование, bcrypt) из async-обработчиков
+# выполняются в общем пуле потоков, чтобы не останавливать цикл событий.
+# Этот же пул anyio использует FastAPI для обычных (def) обработчиков.
+def configure_thread_pool():
+    to_thread.current_default_thread_limiter().total_tokens = settings.worker_threads
+
+
+# Пул занят больше чем наполовину — фоновые задачи уступают запросам
+def thread_pool_busy() -> bool:
+    limiter = to_thread.current_default_thread_limiter()
+    return limiter.borrowed_tokens > limiter.total_tokens // 2
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await to_thread.run_sync(partial(func, *args, **kwargs))
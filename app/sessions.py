@@ -0,0 +1,332 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import jwt
+
+from app.config import settings
+from app.database import FileLock, write_json_atomic, write_text_atomic
+from app.models import User
+
+SESSION_COOKIE = "session"
+SESSION_SECRET_FILE = "venv/app/session.secret"
+REVOKED_SESSIONS_FILE = "venv/app/revoked_sessions.json"
+_ALGORITHM = "HS256"
+
+
+# Минимальная длина секрета: короткий ключ HS256 подбирается перебором,
+# а с пустым PyJWT подписывает и проверяет токены без возражений
+_MIN_SECRET_LENGTH = 32
+
+
+def _read_secret() -> Optional[bytes]:
+    try:
+        with open(SESSION_SECRET_FILE, "r", encoding="utf-8") as f:
+            secret = f.read().strip().encode()
+    except FileNotFoundError:
+        return None
+    return secret if len(secret) >= _MIN_SECRET_LENGTH else None
+
+
+# Секрет из настроек или из файла. Файл создаёт первый процесс под блокировкой: пишет
+# во временный файл, сбрасывает его на диск и атомарно переименовывает, поэтому остальные
+# никогда не видят его недописанным. Пустой или короткий файл (сбой при записи) заменяется.
+def _load_secret() -> bytes:
+    if settings.session_secret:
+        if len(settings.session_secret) < _MIN_SECRET_LENGTH:
+            raise RuntimeError(f"PM_SESSION_SECRET должен быть не короче {_MIN_SECRET_LENGTH} символов")
+        return settings.session_secret.encode()
+    secret = _read_secret()
+    if secret is not None:
+        return secret
+    with FileLock(SESSION_SECRET_FILE).exclusive():
+        secret = _read_secret()
+        if secret is None:
+            secret = secrets.token_urlsafe(48).encode()
+            write_text_atomic(SESSION_SECRET_FILE, secret.decode())
+    return secret
+
+
+# Подписанные сессионные токены (JWT, HS256): имя пользователя, дескриптор ключа,
+# идентификатор сессии (sid), срок действия и jti. Проверка токена не обращается к хранилищу.
+#
+# Дескриптор ключа (kh) — HMAC от ключа шифрования пользователя: сам ключ в токен
+# не попадает, но любой процесс может убедиться, что ключ в кэше тот же. Ключи
+# пользователей держатся в памяти key_ttl секунд; после смены ключа kh перестаёт
+# совпадать, ключ перечитывается из хранилища, а токен перевыпускается.
+# sid выдаётся при входе и переходит во все перевыпущенные токены этого входа, поэтому
+# выход отзывает сразу все его токены. Отозванные sid лежат в revoked_sessions.json
+# (общий для всех воркеров и переживает перезапуск) до истечения последнего токена сессии;
+# копия в памяти перечитывается, только когда другой процесс изменил файл (версия FileLock).
+# Уже проверенные токены запоминаются (вытесняются самые старые), подпись повторно не проверяется:
+# срок и отзыв при этом всё равно проверяются на каждом запросе.
+class SessionTokens:
+    def __init__(self, ttl: float, key_ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.key_ttl = key_ttl
+        self.max_keys = max_keys
+        self._secret: Optional[bytes] = None
+        self._keys: "OrderedDict[str, Tuple[str, str, Optional[str], float]]" = OrderedDict()
+        self._revoked: Dict[str, float] = {}
+        self._revoked_lock = FileLock(REVOKED_SESSIONS_FILE)
+        self._revoke_mutex = threading.Lock()
+        self._verified: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._secret_lock = threading.Lock()
+        self.key_hits = 0
+        self.key_misses = 0
+
+    @property
+    def secret(self) -> bytes:
+        if self._secret is None:
+            with self._secret_lock:
+                if self._secret is None:
+                    self._secret = _load_secret()
+        return self._secret
+
+    def key_handle(self, user_key: str) -> str:
+        return hmac.new(self.secret, user_key.encode(), hashlib.sha256).hexdigest()[:16]
+
+    # Новый токен; sid — идентификатор сессии перевыпускаемого токена, None — новый вход
+    def issue(self, user: User, sid: Optional[str] = None) -> str:
+        now = int(time.time())
+        self.remember(user)
+        return jwt.encode(
+            {
+                "sub": user.username,
+                "kh": self.key_handle(user.encrypted_user_key),
+                "sid": sid or uuid.uuid4().hex,
+                "jti": uuid.uuid4().hex,
+                "iat": now,
+                "exp": now + int(self.ttl),
+            },
+            self.secret,
+            algorithm=_ALGORITHM,
+        )
+
+    # Проверенные claims или None (подпись неверна, срок истёк, токен отозван)
+    def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        claims = self._verified.get(token)
+        if claims is None:
+            try:
+                claims = jwt.decode(
+                    token, self.secret, algorithms=[_ALGORITHM], options={"require": ["sub", "kh", "jti", "exp"]}
+                )
+            except jwt.InvalidTokenError:
+                return None
+            with self._lock:
+                self._verified[token] = claims
+                while len(self._verified) > self.max_keys:
+                    self._verified.popitem(last=False)
+        elif claims["exp"] <= time.time():
+            return None
+        if self.is_revoked(claims):
+            return None
+        return claims
+
+    # Токен прожил больше половины срока — пора выдать новый
+    def needs_refresh(self, claims: Dict[str, Any]) -> bool:
+        return claims["exp"] - time.time() < self.ttl / 2
+
+    def _sync_revoked(self):
+        if self._revoked_lock.stale:
+            with self._lock:
+                if self._revoked_lock.stale:
+                    self._revoked = _load_revoked()
+                    self._revoked_lock.mark_synced()
+
+    def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        with self._revoked_lock.shared():
+            self._sync_revoked()
+            return session_id(claims) in self._revoked
+
+    # Отзыв всей сессии: действует, пока не истечёт любой токен, выданный ей до сих пор
+    def revoke(self, claims: Dict[str, Any]):
+        now = time.time()
+        with self._revoked_lock.exclusive(), self._revoke_mutex:
+            self._sync_revoked()
+            revoked = {sid: exp for sid, exp in self._revoked.items() if exp > now}
+            revoked[session_id(claims)] = now + self.ttl
+            write_json_atomic(REVOKED_SESSIONS_FILE, revoked)
+            self._revoked = revoked
+            self._revoked_lock.mark_dirty()
+
+    # Ключи пользователя (текущий, прежний) из памяти, если дескриптор совпадает
+    def keys_for(self, username: str, handle: str) -> Optional[Tuple[str, Optional[str]]]:
+        entry = self._keys.get(username)
+        if entry is None or entry[0] != handle or entry[3] < time.monotonic():
+            self.key_misses += 1
+            return None
+        self.key_hits += 1
+        return entry[1], entry[2]
+
+    def remember(self, user: User) -> str:
+        handle = self.key_handle(user.encrypted_user_key)
+        with self._lock:
+            self._keys[user.username] = (
+                handle, user.encrypted_user_key, user.previous_user_key, time.monotonic() + self.key_ttl
+            )
+            self._keys.move_to_end(user.username)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        return handle
+
+    def forget(self, username: str):
+        with self._lock:
+            self._keys.pop(username, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "key_hits": self.key_hits,
+            "key_misses": self.key_misses,
+            "cached_keys": len(self._keys),
+            "revoked": len(self._revoked),
+        }
+
+
+# Токены, выпущенные до появления sid, отзываются по своему jti
+def session_id(claims: Dict[str, Any]) -> str:
+    return claims.get("sid") or claims["jti"]
+
+
+def _load_revoked() -> Dict[str, float]:
+    try:
+        with open(REVOKED_SESSIONS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        print(" revoked_sessions.json повреждён. Отозванные сессии потеряны.")
+        return {}
+
+
+session_tokens = SessionTokens(settings.session_ttl, settings.session_key_ttl, settings.session_key_cache_size)
+
+
+SESSION_ID_COOKIE = "sid"
+# Примерный размер служебных структур одной сессии (объект, запись в словарях)
+_SESSION_OVERHEAD = 400
+
+
+class _Session:
+    __slots__ = ("username", "user_key", "previous_user_key", "expires", "size")
+
+    def __init__(self, username: str, user_key: str, previous_user_key: Optional[str], expires: float, size: int):
+        self.username = username
+        self.user_key = user_key
+        self.previous_user_key = previous_user_key
+        self.expires = expires
+        self.size = size
+
+
+# Сессии на сервере: случайный идентификатор в cookie, всё остальное — в памяти процесса.
+# Порядок словаря — порядок последнего обращения (LRU); каждое обращение продлевает
+# срок на ttl (скользящий срок). Общий объём ограничен max_bytes: при превышении
+# вытесняются давно не использованные сессии. Истёкшие удаляет фоновая задача reap_forever.
+# Сессии не разделяются между процессами — режим рассчитан на один worker.
+class SessionStore:
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._by_user: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def create(self, user: User) -> str:
+        sid = secrets.token_urlsafe(32)
+        size = _SESSION_OVERHEAD + sum(
+            len(v) for v in (sid, user.username, user.encrypted_user_key, user.previous_user_key or "")
+        )
+        session = _Session(user.username, user.encrypted_user_key, user.previous_user_key,
+                           time.monotonic() + self.ttl, size)
+        with self._lock:
+            self._sessions[sid] = session
+            self._by_user.setdefault(user.username, set()).add(sid)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._sessions) > 1:
+                self._remove(next(iter(self._sessions)))
+                self.evicted += 1
+        return sid
+
+    def get(self, sid: str) -> Optional[_Session]:
+        session = self._sessions.get(sid)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if session.expires < now:
+            with self._lock:
+                if sid in self._sessions:
+                    self._remove(sid)
+                    self.expired += 1
+            return None
+        session.expires = now + self.ttl
+        with self._lock:
+            if sid in self._sessions:
+                self._sessions.move_to_end(sid)
+        return session
+
+    def delete(self, sid: str):
+        with self._lock:
+            if sid in self._sessions:
+                self._remove(sid)
+
+    # Ключи пользователя изменились (смена ключа) — обновляем все его сессии
+    def update_user(self, user: User):
+        with self._lock:
+            for sid in self._by_user.get(user.username, ()):
+                session = self._sessions[sid]
+                session.user_key = user.encrypted_user_key
+                session.previous_user_key = user.previous_user_key
+
+    def _remove(self, sid: str):
+        session = self._sessions.pop(sid)
+        self.bytes -= session.size
+        sids = self._by_user.get(session.username)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_user[session.username]
+
+    # Срок одинаков и продлевается при каждом обращении, поэтому в порядке LRU
+    # истёкшие сессии идут первыми: проход останавливается на первой живой
+    def reap(self) -> int:
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            while self._sessions:
+                sid, session = next(iter(self._sessions.items()))
+                if session.expires >= now:
+                    break
+                self._remove(sid)
+                removed += 1
+            self.expired += removed
+        return removed
+
+    async def reap_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.reap()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+session_store = SessionStore(settings.session_ttl, settings.session_store_max_bytes)
@@ -0,0 +1,614 @@
+import queue
+import sqlite3
+import sys
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from app.config import settings
+from app.models import User
+from app.database import load_users, save_users, find_user, find_user_cached, records_store, RecordStore, FileLock, USERS_FILE
+from app.indexes import sort_key, tokenize
+from app.domains import url_domain
+
+
+class UserExistsError(Exception):
+    pass
+
+
+# Единый интерфейс доступа к данным: auth, middleware и обработчики паролей
+# работают только через него и не знают, где на самом деле лежат данные.
+class StorageBackend(ABC):
+    @abstractmethod
+    def get_user(self, username: str) -> Optional[User]: ...
+
+    # Поиск без блокирующего ввода-вывода, можно вызывать прямо из цикла событий.
+    # (False, None) — в памяти ответа нет, нужен get_user в пуле потоков.
+    def get_user_cached(self, username: str) -> Tuple[bool, Optional[User]]:
+        return False, None
+
+    @abstractmethod
+    def add_user(self, user: User): ...
+
+    @abstractmethod
+    def update_user(self, user: User): ...
+
+    # Точечное изменение полей пользователя. Если задан expected, изменение
+    # применяется, только если текущие значения совпадают; иначе (и если
+    # пользователя нет) возвращается None.
+    @abstractmethod
+    def update_user_fields(self, username: str, fields: Dict[str, Any],
+                           expected: Optional[Dict[str, Any]] = None) -> Optional[User]: ...
+
+    # Пользователи с незавершённой сменой ключа
+    @abstractmethod
+    def list_rotating_users(self) -> List[str]: ...
+
+    @abstractmethod
+    def get_record(self, username: str, record_id: int) -> Optional[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def list_records(self, username: str) -> List[Dict[str, Any]]: ...
+
+    # Страница для keyset-пагинации: записи в порядке поля sort (см. app.indexes.SORT_FIELDS),
+    # строго после записи after = (значение поля, id), не больше limit штук
+    @abstractmethod
+    def list_records_page(self, username: str, sort: str, after: Optional[Tuple[Optional[str], int]],
+                          limit: int, descending: bool = False) -> List[Dict[str, Any]]: ...
+
+    # Поиск по названию, логину и адресу: каждое слово запроса — начало слова записи.
+    # До limit записей, лучшие совпадения первыми.
+    @abstractmethod
+    def search_records(self, username: str, query: str, limit: int) -> List[Dict[str, Any]]: ...
+
+    # Версия хранилища пользователя: растёт при каждом изменении его записей
+    # (создание, изменение, удаление, перешифрование). 0 — изменений ещё не было.
+    @abstractmethod
+    def vault_version(self, username: str) -> int: ...
+
+    # Изменения для синхронизации после версии since: (текущая версия, новые и изменённые
+    # записи по возрастанию версии, id удалённых). since=0 — все записи.
+    # None — клиент отстал сильнее, чем хранятся удаления: нужна полная синхронизация.
+    @abstractmethod
+    def record_changes(self, username: str, since: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[int]]]: ...
+
+    # Записи, адрес которых относится к регистрируемому домену domain (app.domains.registrable_domain)
+    @abstractmethod
+    def find_records_by_domain(self, username: str, domain: str) -> List[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def count_records(self, username: str) -> int: ...
+
+    @abstractmethod
+    def create_record(self, username: str, fields: Dict[str, Any]) -> Dict[str, Any]: ...
+
+    @abstractmethod
+    def update_record(self, username: str, record_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def delete_record(self, username: str, record_id: int) -> bool: ...
+
+    # Перешифрование: swaps — id -> (ожидаемый, новый) encrypted_password.
+    # Запись заменяется, только если её шифротекст всё ещё равен ожидаемому;
+    # возвращаются id заменённых записей.
+    @abstractmethod
+    def swap_encrypted_passwords(self, username: str, swaps: Dict[int, Tuple[str, str]]) -> List[int]: ...
+
+
+# Хранение в JSON-файлах (по умолчанию): пользователи — users.json,
+# записи — RecordStore из app.database.
+class JsonStorage(StorageBackend):
+    def __init__(self, records: RecordStore = records_store):
+        self.records = records
+        self._users_lock = FileLock(USERS_FILE)
+        self._users_mutex = threading.Lock()
+
+    def get_user(self, username: str) -> Optional[User]:
+        return find_user(username)
+
+    def get_user_cached(self, username: str) -> Tuple[bool, Optional[User]]:
+        return find_user_cached(username)
+
+    # Чтение — изменение — запись users.json. FileLock исключает другие процессы,
+    # но потоки одного процесса держат его совместно: их дополнительно
+    # выстраивает в очередь обычный мьютекс, иначе последний снимок затрёт остальные.
+    @contextmanager
+    def _users_update(self):
+        with self._users_lock.exclusive(), self._users_mutex:
+            yield load_users()
+
+    def add_user(self, user: User):
+        with self._users_update() as users:
+            if any(u.username == user.username for u in users):
+                raise UserExistsError(user.username)
+            users.append(user)
+            save_users(users)
+
+    def update_user(self, user: User):
+        with self._users_update() as users:
+            users = [user if u.username == user.username else u for u in users]
+            save_users(users)
+
+    def update_user_fields(self, username: str, fields: Dict[str, Any],
+                           expected: Optional[Dict[str, Any]] = None) -> Optional[User]:
+        with self._users_update() as users:
+            for i, u in enumerate(users):
+                if u.username != username:
+                    continue
+                if expected and any(getattr(u, k) != v for k, v in expected.items()):
+                    return None
+                users[i] = u.model_copy(update=fields)
+                save_users(users)
+                return users[i]
+        return None
+
+    def list_rotating_users(self) -> List[str]:
+        return [u.username for u in load_users() if u.previous_user_key]
+
+    def get_record(self, username: str, record_id: int) -> Optional[Dict[str, Any]]:
+        return self.records.get(username, record_id)
+
+    def list_records(self, username: str) -> List[Dict[str, Any]]:
+        return self.records.list_for_user(username)
+
+    def list_records_page(self, username: str, sort: str, after: Optional[Tuple[Optional[str], int]],
+                          limit: int, descending: bool = False) -> List[Dict[str, Any]]:
+        after_key = sort_key(sort, *after) if after is not None else None
+        return self.records.page(username, sort, after_key, limit, descending)
+
+    def search_records(self, username: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        return self.records.search(username, query, limit)
+
+    def vault_version(self, username: str) -> int:
+        return self.records.version(username)
+
+    def record_changes(self, username: str, since: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[int]]]:
+        return self.records.changes(username, since)
+
+    def find_records_by_domain(self, username: str, domain: str) -> List[Dict[str, Any]]:
+        return self.records.by_domain(username, domain)
+
+    def count_records(self, username: str) -> int:
+        return self.records.count_for_user(username)
+
+    def create_record(self, username: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return self.records.create(username, fields)
+
+    def update_record(self, username: str, record_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.records.update(username, record_id, fields)
+
+    def delete_record(self, username: str, record_id: int) -> bool:
+        return self.records.delete(username, record_id)
+
+    def swap_encrypted_passwords(self, username: str, swaps: Dict[int, Tuple[str, str]]) -> List[int]:
+        return self.records.swap_encrypted_passwords(username, swaps)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    hashed_password TEXT NOT NULL,
+    encrypted_user_key TEXT NOT NULL,
+    previous_user_key TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username);
+
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    title TEXT NOT NULL,
+    login TEXT NOT NULL,
+    encrypted_password TEXT NOT NULL,
+    url TEXT,
+    notes TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    domain TEXT,
+    version INTEGER
+);
+CREATE INDEX IF NOT EXISTS ix_records_username_id ON records (username, id);
+CREATE INDEX IF NOT EXISTS ix_records_username_title ON records (username, title COLLATE NOCASE, id);
+CREATE INDEX IF NOT EXISTS ix_records_username_created ON records (username, COALESCE(created_at, ''), id);
+CREATE INDEX IF NOT EXISTS ix_records_username_updated ON records (username, COALESCE(updated_at, ''), id);
+"""
+
+# Версии хранилищ пользователей и синхронизация. Триггеры в той же транзакции, что и
+# изменение записи, увеличивают версию хранилища, записывают её в records.version,
+# а при удалении оставляют отметку в record_tombstones. Старые отметки удаляет
+# delete_record (их срок задаётся настройками); horizon — версия самой свежей удалённой отметки.
+SYNC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vaults (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    horizon INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS record_tombstones (
+    username TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (username, version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_records_username_version ON records (username, version);
+CREATE TRIGGER IF NOT EXISTS records_sync_insert AFTER INSERT ON records BEGIN
+    INSERT INTO vaults (username, version) VALUES (new.username, 1)
+    ON CONFLICT (username) DO UPDATE SET version = version + 1;
+    UPDATE records SET version = (SELECT version FROM vaults WHERE username = new.username) WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS records_sync_update
+AFTER UPDATE OF username, title, login, encrypted_password, url, notes ON records BEGIN
+    INSERT INTO vaults (username, version) VALUES (new.username, 1)
+    ON CONFLICT (username) DO UPDATE SET version = version + 1;
+    UPDATE records SET version = (SELECT version FROM vaults WHERE username = new.username) WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS records_sync_delete AFTER DELETE ON records BEGIN
+    INSERT INTO vaults (username, version) VALUES (old.username, 1)
+    ON CONFLICT (username) DO UPDATE SET version = version + 1;
+    INSERT INTO record_tombstones (username, version, id)
+    SELECT old.username, version, old.id FROM vaults WHERE username = old.username;
+END;
+"""
+
+# Полнотекстовый индекс FTS5 поверх records (external content): хранит только слова,
+# триггеры поддерживают его при изменении записей. prefix — готовые индексы префиксов
+# из 2 и 3 символов, чтобы короткие префиксы не требовали обхода всего словаря.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5(
+    username, title, login, url,
+    content='records', content_rowid='id', prefix='2 3', tokenize="unicode61 tokenchars '_'"
+);
+CREATE TRIGGER IF NOT EXISTS records_fts_insert AFTER INSERT ON records BEGIN
+    INSERT INTO records_fts (rowid, username, title, login, url)
+    VALUES (new.id, new.username, new.title, new.login, new.url);
+END;
+CREATE TRIGGER IF NOT EXISTS records_fts_delete AFTER DELETE ON records BEGIN
+    INSERT INTO records_fts (records_fts, rowid, username, title, login, url)
+    VALUES ('delete', old.id, old.username, old.title, old.login, old.url);
+END;
+CREATE TRIGGER IF NOT EXISTS records_fts_update AFTER UPDATE OF username, title, login, url ON records BEGIN
+    INSERT INTO records_fts (records_fts, rowid, username, title, login, url)
+    VALUES ('delete', old.id, old.username, old.title, old.login, old.url);
+    INSERT INTO records_fts (rowid, username, title, login, url)
+    VALUES (new.id, new.username, new.title, new.login, new.url);
+END;
+"""
+
+# Выражения сортировки совпадают с выражениями индексов выше, иначе SQLite их не использует
+SORT_EXPRESSIONS = {
+    "title": "title COLLATE NOCASE",
+    "created_at": "COALESCE(created_at, '')",
+    "updated_at": "COALESCE(updated_at, '')",
+}
+
+RECORD_COLUMNS = ("title", "login", "encrypted_password", "url", "notes")
+USER_COLUMNS = ("username", "hashed_password", "encrypted_user_key", "previous_user_key")
+
+
+# Регистрируемый домен адреса записи для колонки records.domain
+def _record_domain(url: Optional[str]) -> Optional[str]:
+    parsed = url_domain(url)
+    return parsed[1] if parsed else None
+
+
+# SQLite в режиме WAL: читатели не блокируют писателя.
+# Соединения берутся из пула, размер которого совпадает с пулом рабочих потоков.
+class SqliteStorage(StorageBackend):
+    def __init__(self, path: str, pool_size: int = 40):
+        self.path = path
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._pool_size = pool_size
+        self._created = 0
+        self._pool_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+            # базы, созданные до появления смены ключа
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+            if "previous_user_key" not in columns:
+                conn.execute("ALTER TABLE users ADD COLUMN previous_user_key TEXT")
+            # базы, созданные до появления поиска: индекс заполняется по уже сохранённым записям
+            has_search = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'records_fts'"
+            ).fetchone()
+            conn.executescript(SEARCH_SCHEMA)
+            if not has_search:
+                conn.execute("INSERT INTO records_fts (records_fts) VALUES ('rebuild')")
+            # базы, созданные до появления поиска по адресу: домен вычисляется для старых записей
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(records)")}
+            if "domain" not in columns:
+                conn.execute("ALTER TABLE records ADD COLUMN domain TEXT")
+                rows = conn.execute("SELECT id, url FROM records WHERE url IS NOT NULL").fetchall()
+                conn.executemany(
+                    "UPDATE records SET domain = ? WHERE id = ?",
+                    [(_record_domain(r["url"]), r["id"]) for r in rows],
+                )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_records_username_domain ON records (username, domain)")
+            # базы, созданные до появления синхронизации: версии записей и границы удалений
+            if "version" not in columns:
+                conn.execute("ALTER TABLE records ADD COLUMN version INTEGER")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'vaults'").fetchone():
+                if "horizon" not in {row["name"] for row in conn.execute("PRAGMA table_info(vaults)")}:
+                    conn.execute("ALTER TABLE vaults ADD COLUMN horizon INTEGER NOT NULL DEFAULT 0")
+            for trigger in ("vaults_version_insert", "vaults_version_update", "vaults_version_delete"):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.executescript(SYNC_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_create = self._created < self._pool_size
+                if can_create:
+                    self._created += 1
+            conn = self._connect() if can_create else self._pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
+    def get_user(self, username: str) -> Optional[User]:
+        with self._connection() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE username = ?",
+                (username,),
+            ).fetchone()
+        return User(**dict(row)) if row else None
+
+    def add_user(self, user: User):
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, hashed_password, encrypted_user_key, previous_user_key)"
+                    " VALUES (:username, :hashed_password, :encrypted_user_key, :previous_user_key)",
+                    user.model_dump(),
+                )
+        except sqlite3.IntegrityError:
+            raise UserExistsError(user.username)
+
+    def update_user(self, user: User):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE users SET hashed_password = :hashed_password, encrypted_user_key = :encrypted_user_key,"
+                " previous_user_key = :previous_user_key WHERE username = :username",
+                user.model_dump(),
+            )
+
+    def update_user_fields(self, username: str, fields: Dict[str, Any],
+                           expected: Optional[Dict[str, Any]] = None) -> Optional[User]:
+        fields = {c: fields[c] for c in USER_COLUMNS if c in fields}
+        expected = {c: expected[c] for c in USER_COLUMNS if c in (expected or {})}
+        assignments = ", ".join(f"{c} = :{c}" for c in fields)
+        # IS, а не =, чтобы ожидаемое значение NULL тоже сравнивалось
+        conditions = "".join(f" AND {c} IS :_expected_{c}" for c in expected)
+        params = {**fields, **{f"_expected_{c}": v for c, v in expected.items()}, "_username": username}
+        with self._connection() as conn:
+            cur = conn.execute(
+                f"UPDATE users SET {assignments} WHERE username = :_username{conditions}", params
+            )
+            if cur.rowcount == 0:
+                return None
+            row = conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        return User(**dict(row))
+
+    def list_rotating_users(self) -> List[str]:
+        with self._connection() as conn:
+            rows = conn.execute("SELECT username FROM users WHERE previous_user_key IS NOT NULL").fetchall()
+        return [r["username"] for r in rows]
+
+    def get_record(self, username: str, record_id: int) -> Optional[Dict[str, Any]]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM records WHERE username = ? AND id = ?", (username, record_id)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list_records(self, username: str) -> List[Dict[str, Any]]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM records WHERE username = ? ORDER BY id", (username,)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def list_records_page(self, username: str, sort: str, after: Optional[Tuple[Optional[str], int]],
+                          limit: int, descending: bool = False) -> List[Dict[str, Any]]:
+        expr = SORT_EXPRESSIONS[sort]
+        direction, op = ("DESC", "<") if descending else ("ASC", ">")
+        query = "SELECT * FROM records WHERE username = ?"
+        params: list = [username]
+        if after is not None:
+            # эквивалент ({expr}, id) > (?, ?), но в такой форме граница попадает в поиск по индексу
+            query += f" AND {expr} {op}= ? AND ({expr} {op} ? OR id {op} ?)"
+            value = after[0] or ""
+            params += [value, value, after[1]]
+        query += f" ORDER BY {expr} {direction}, id {direction} LIMIT ?"
+        params.append(limit)
+        with self._connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [dict(r) for r in rows]
+
+    # Оценка — bm25 с весами колонок как в app.indexes.SEARCH_FIELDS (username не учитывается);
+    # фраза по username сужает выборку внутри FTS, точное совпадение проверяется по records
+    def search_records(self, username: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        user_terms = tokenize(username)
+        if not terms:
+            return []
+        match = "{title login url} : (" + " AND ".join(f'"{t}"*' for t in terms) + ")"
+        if user_terms:
+            match = f'username : "{" ".join(user_terms)}" AND {match}'
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT r.* FROM records_fts JOIN records r ON r.id = records_fts.rowid"
+                " WHERE records_fts MATCH ? AND r.username = ?"
+                " ORDER BY bm25(records_fts, 0, 3, 2, 1), r.id LIMIT ?",
+                (match, username, limit),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def vault_version(self, username: str) -> int:
+        with self._connection() as conn:
+            row = conn.execute("SELECT version FROM vaults WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else 0
+
+    def record_changes(self, username: str, since: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[int]]]:
+        with self._connection() as conn:
+            # все чтения — из одного снимка базы
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT version, horizon FROM vaults WHERE username = ?", (username,)).fetchone()
+            version, horizon = (row["version"], row["horizon"]) if row else (0, 0)
+            if since > version or (since and since < horizon):
+                return None
+            if not since:
+                return version, [dict(r) for r in conn.execute(
+                    "SELECT * FROM records WHERE username = ? ORDER BY id", (username,)
+                )], []
+            changed = conn.execute(
+                "SELECT * FROM records WHERE username = ? AND version > ? ORDER BY version", (username, since)
+            ).fetchall()
+            deleted = conn.execute(
+                "SELECT id FROM record_tombstones WHERE username = ? AND version > ? ORDER BY version",
+                (username, since),
+            ).fetchall()
+        return version, [dict(r) for r in changed], [r["id"] for r in deleted]
+
+    def find_records_by_domain(self, username: str, domain: str) -> List[Dict[str, Any]]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM records WHERE username = ? AND domain = ? ORDER BY id", (username, domain)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def count_records(self, username: str) -> int:
+        with self._connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM records WHERE username = ?", (username,)
+            ).fetchone()[0]
+
+    def create_record(self, username: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        now = datetime.utcnow().isoformat()
+        record = {"username": username, **{c: fields.get(c) for c in RECORD_COLUMNS},
+                  "created_at": now, "updated_at": now, "domain": _record_domain(fields.get("url"))}
+        with self._connection() as conn:
+            cur = conn.execute(
+                "INSERT INTO records (username, title, login, encrypted_password, url, notes, created_at, updated_at, domain)"
+                " VALUES (:username, :title, :login, :encrypted_password, :url, :notes, :created_at, :updated_at, :domain)",
+                record,
+            )
+        return {"id": cur.lastrowid, **record}
+
+    def update_record(self, username: str, record_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        changes = {c: fields[c] for c in RECORD_COLUMNS if c in fields}
+        changes["updated_at"] = datetime.utcnow().isoformat()
+        if "url" in changes:
+            changes["domain"] = _record_domain(changes["url"])
+        assignments = ", ".join(f"{c} = :{c}" for c in changes)
+        with self._connection() as conn:
+            cur = conn.execute(
+                f"UPDATE records SET {assignments} WHERE username = :_username AND id = :_id",
+                {**changes, "_username": username, "_id": record_id},
+            )
+            if cur.rowcount == 0:
+                return None
+            row = conn.execute(
+                "SELECT * FROM records WHERE username = ? AND id = ?", (username, record_id)
+            ).fetchone()
+        return dict(row)
+
+    def delete_record(self, username: str, record_id: int) -> bool:
+        with self._connection() as conn:
+            cur = conn.execute(
+                "DELETE FROM records WHERE username = ? AND id = ?", (username, record_id)
+            )
+            if cur.rowcount:
+                self._trim_tombstones(conn, username)
+        return cur.rowcount > 0
+
+    # Отметки об удалении старше sync_retention версий забываются, horizon сдвигается за ними
+    @staticmethod
+    def _trim_tombstones(conn: sqlite3.Connection, username: str):
+        cutoff = conn.execute(
+            "SELECT version FROM vaults WHERE username = ?", (username,)
+        ).fetchone()[0] - settings.sync_retention
+        dropped = conn.execute(
+            "SELECT MAX(version) FROM record_tombstones WHERE username = ? AND version <= ?", (username, cutoff)
+        ).fetchone()[0]
+        if dropped is not None:
+            conn.execute("DELETE FROM record_tombstones WHERE username = ? AND version <= ?", (username, cutoff))
+            conn.execute("UPDATE vaults SET horizon = MAX(horizon, ?) WHERE username = ?", (dropped, username))
+
+    def swap_encrypted_passwords(self, username: str, swaps: Dict[int, Tuple[str, str]]) -> List[int]:
+        swapped = []
+        with self._connection() as conn:
+            for record_id, (expected, new) in swaps.items():
+                cur = conn.execute(
+                    "UPDATE records SET encrypted_password = ?"
+                    " WHERE username = ? AND id = ? AND encrypted_password = ?",
+                    (new, username, record_id, expected),
+                )
+                if cur.rowcount:
+                    swapped.append(record_id)
+        return swapped
+
+
+def _make_storage() -> StorageBackend:
+    if settings.storage_backend == "sqlite":
+        return SqliteStorage(settings.sqlite_path, pool_size=settings.storage_pool_size or settings.worker_threads)
+    return JsonStorage()
+
+
+storage = _make_storage()
+
+
+# Однократный перенос данных из users.json / password_records.json в SQLite:
+#   python -m app.storage migrate
+def migrate_json_to_sqlite(path: str = settings.sqlite_path):
+    target = SqliteStorage(path)
+    users = load_users()
+    records = records_store.snapshot()
+    vaults = records_store.dump_data()["vaults"]
+    with target._connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (username, hashed_password, encrypted_user_key, previous_user_key)"
+            " VALUES (:username, :hashed_password, :encrypted_user_key, :previous_user_key)",
+            [u.model_dump() for u in users],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO records"
+            " (id, username, title, login, encrypted_password, url, notes, created_at, updated_at, domain)"
+            " VALUES (:id, :username, :title, :login, :encrypted_password, :url, :notes, :created_at, :updated_at, :domain)",
+            [{"url": None, "notes": None, "created_at": None, "updated_at": None, **r,
+              "domain": _record_domain(r.get("url"))} for r in records],
+        )
+        # версии и удаления переносятся как есть, а не те, что насчитали триггеры при вставке
+        conn.executemany(
+            "UPDATE records SET version = ? WHERE id = ?", [(r.get("version", 0), r["id"]) for r in records]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO vaults (username, version, horizon) VALUES (?, ?, ?)",
+            [(username, v.get("version", 0), v.get("horizon", 0)) for username, v in vaults.items()],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO record_tombstones (username, version, id) VALUES (?, ?, ?)",
+            [(username, version, record_id) for username, v in vaults.items() for version, record_id in v.get("deleted", [])],
+        )
+    print(f"Перенесено пользователей: {len(users)}, записей: {len(records)} -> {path}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        migrate_json_to_sqlite()
+    else:
+        print("Использование: python -m app.storage migrate")
@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException
+
+from app.config import settings
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "failures", "blocked_until")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.blocked_until = 0.0
+
+
+# Ограничение попыток входа до проверки bcrypt: token bucket на каждый ключ
+# (имя пользователя, адрес клиента) и экспоненциальная пауза после неудачных попыток.
+# Ключи хранятся в OrderedDict в порядке последнего обращения: неактивные дольше ttl
+# удаляются с начала, а при превышении max_keys вытесняются самые старые,
+# поэтому память ограничена даже при миллионах разных ключей. Имя пользователя
+# в ключ попадает только как короткий хэш (см. user_key), а отклонённая попытка
+# не создаёт новых ключей — размер ключа не зависит от присланных данных.
+class LoginThrottle:
+    def __init__(self, rate_per_minute: float, burst: int, backoff_base: float,
+                 backoff_max: float, ttl: float, max_keys: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, _Bucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str, now: float) -> _Bucket:
+        bucket = self._existing(key, now)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.burst, now)
+        return bucket
+
+    # Уже известный ключ (с пополненными токенами) или None
+    def _existing(self, key: str, now: float) -> Optional[_Bucket]:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _expire(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < self.ttl and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    # Возвращает None, если попытка разрешена (и списывает токен со всех ключей),
+    # иначе — через сколько секунд можно повторить. Ключи проверяются по порядку,
+    # и на первом исчерпанном попытка отклоняется, не заводя остальные:
+    # новый ключ всегда полон, поэтому до разрешения его можно не создавать.
+    def acquire(self, *keys: str) -> Optional[float]:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            for key in keys:
+                bucket = self._existing(key, now)
+                if bucket is None:
+                    continue
+                wait = 0.0
+                if bucket.blocked_until > now:
+                    wait = bucket.blocked_until - now
+                if bucket.tokens < 1:
+                    wait = max(wait, (1 - bucket.tokens) / self.rate)
+                if wait > 0:
+                    return wait
+            for key in keys:
+                self._bucket(key, now).tokens -= 1
+            self._expire(now)
+            return None
+
+    def failure(self, *keys: str):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                bucket = self._bucket(key, now)
+                bucket.failures += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (bucket.failures - 1))
+                bucket.blocked_until = now + delay
+
+    def success(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.failures = 0
+                    bucket.blocked_until = 0.0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+login_throttle = LoginThrottle(
+    rate_per_minute=settings.login_rate_per_minute,
+    burst=settings.login_burst,
+    backoff_base=settings.login_backoff_base,
+    backoff_max=settings.login_backoff_max,
+    ttl=settings.login_throttle_ttl,
+    max_keys=settings.login_throttle_max_keys,
+)
+
+
+# Ключ лимита по имени пользователя. Имя ещё не проверено моделью и может быть
+# любой длины, поэтому хранится только начало его SHA-256.
+def user_key(username: str) -> str:
+    return "user:" + hashlib.sha256(username.encode("utf-8")).hexdigest()[:16]
+
+
+def check_throttle(*keys: str):
+    retry_after = login_throttle.acquire(*keys)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много попыток, попробуйте позже",
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
@@ -0,0 +1,20 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+# Приложение открывает свои файлы по путям venv/app/... от текущего каталога,
+# поэтому каждый тест работает в пустом каталоге с копией шаблонов и статики
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    app_dir = tmp_path / "venv" / "app"
+    for name in ("templates", "static"):
+        shutil.copytree(os.path.join(ROOT, "app", name), app_dir / name)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
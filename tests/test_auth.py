@@ -0,0 +1,52 @@
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+
+# Пользователь разрешается не больше одного раза за запрос: middleware, зависимости
+# get_current_username и get_user_key и обработчик берут его из кэша запроса.
+# Обращение к хранилищу — вызов get_user или ответ get_user_cached из индекса в памяти;
+# промах get_user_cached ((False, None) — индекс устарел) обращением не считается.
+def test_one_user_store_access_per_request(workdir, monkeypatch):
+    from app.auth import get_current_username, get_user_key
+    from app.config import settings
+    from app.crypto import generate_user_key
+    from app.middleware import AuthMiddleware
+    from app.models import User
+    from app.passwords import router
+    from app.storage import storage
+
+    monkeypatch.setattr(settings, "session_mode", "cookie")
+    storage.add_user(User(username="alice", hashed_password="-", encrypted_user_key=generate_user_key()))
+
+    accesses = []
+    get_user, get_user_cached = storage.get_user, storage.get_user_cached
+
+    def counted_get_user(username):
+        accesses.append("get_user")
+        return get_user(username)
+
+    def counted_get_user_cached(username):
+        found, user = get_user_cached(username)
+        if found:
+            accesses.append("get_user_cached")
+        return found, user
+
+    monkeypatch.setattr(storage, "get_user", counted_get_user)
+    monkeypatch.setattr(storage, "get_user_cached", counted_get_user_cached)
+
+    app = FastAPI()
+    app.add_middleware(AuthMiddleware)
+    app.include_router(router)
+
+    @app.get("/whoami")
+    def whoami(username: str = Depends(get_current_username), user_key: str = Depends(get_user_key)):
+        return {"username": username, "has_key": bool(user_key)}
+
+    client = TestClient(app, cookies={"X-Username": "alice"})
+    # первый запрос идёт мимо индекса в памяти (users.json только что записан), следующие — через него
+    for path in ("/whoami", "/whoami", "/passwords/"):
+        accesses.clear()
+        response = client.get(path)
+        assert response.status_code == 200, response.text
+        assert len(accesses) == 1, (path, accesses)
+    assert client.get("/whoami").json() == {"username": "alice", "has_key": True}
@@ -0,0 +1,120 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+# Несколько процессов с приложением пишут в одно хранилище одновременно:
+# ни одна запись и ни одно изменение не должны потеряться, id — не повторяться
+PROCESSES = 4
+THREADS = 6
+PER_THREAD = 40
+USERS = ("alice", "bob")
+
+
+# Функции ниже выполняются в дочерних процессах (spawn): каждый импортирует
+# приложение заново и видит только то, что лежит на диске
+def _client(username):
+    from fastapi.testclient import TestClient
+    from app.main import app
+    return TestClient(app, cookies={"X-Username": username})
+
+
+# Пользователи заводятся прямо в хранилище: тесту нужны только они сами, а не пул bcrypt
+def _register(*usernames):
+    from app.crypto import generate_user_key
+    from app.models import User
+    from app.storage import storage
+
+    def add(username):
+        storage.add_user(User(username=username, hashed_password="-", encrypted_user_key=generate_user_key()))
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(add, usernames))
+
+
+def _write(worker):
+    from app.storage import storage
+    username = USERS[worker % len(USERS)]
+    prefix = f"w{worker}-"
+
+    def create(thread):
+        client = _client(username)
+        for i in range(PER_THREAD):
+            response = client.post("/passwords/add", follow_redirects=False, data={
+                "title": f"{prefix}t{thread}-{i}", "login": "login", "password": "secret",
+            })
+            assert response.status_code == 303, response.text
+
+    def update(records):
+        client = _client(username)
+        for record in records:
+            response = client.patch(f"/passwords/{record['id']}", json={"title": record["title"] + "-upd"})
+            assert response.status_code == 200, response.text
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(create, range(THREADS)))
+        # свои записи обновляются, пока другие процессы ещё пишут
+        own = [r for r in storage.list_records(username) if r["title"].startswith(prefix)]
+        list(pool.map(update, [own[i::THREADS] for i in range(THREADS)]))
+    return len(own)
+
+
+def _read():
+    from app.storage import storage
+    return {username: storage.list_records(username) for username in USERS}
+
+
+def _registered(*usernames):
+    from app.storage import storage
+    return [username for username in usernames if storage.get_user(username) is not None]
+
+
+@pytest.mark.parametrize("env", [
+    {"PM_RECORDS_STORAGE": "snapshot"},
+    {"PM_RECORDS_STORAGE": "journal", "PM_JOURNAL_MAX_OPS": "3"},
+    {"PM_RECORDS_STORAGE": "sharded"},
+    {"PM_STORAGE_BACKEND": "sqlite"},
+], ids=lambda env: "-".join(env.values()))
+def test_parallel_writes_from_several_processes(workdir, monkeypatch, env):
+    for name, value in {**env, "PM_SESSION_MODE": "cookie", "PM_ID_BLOCK_SIZE": "10"}.items():
+        monkeypatch.setenv(name, value)
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        pool.submit(_register, *USERS).result()
+
+    with ProcessPoolExecutor(PROCESSES, mp_context=context) as pool:
+        seen = list(pool.map(_write, range(PROCESSES)))
+    assert seen == [THREADS * PER_THREAD] * PROCESSES
+
+    # проверка — в новом процессе, который читает только диск
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        stored = pool.submit(_read).result()
+
+    all_ids = [r["id"] for records in stored.values() for r in records]
+    assert len(all_ids) == len(set(all_ids)) == PROCESSES * THREADS * PER_THREAD
+    for index, username in enumerate(USERS):
+        expected = {
+            f"w{worker}-t{thread}-{i}-upd"
+            for worker in range(index, PROCESSES, len(USERS))
+            for thread in range(THREADS)
+            for i in range(PER_THREAD)
+        }
+        assert {r["title"] for r in stored[username]} == expected
+
+
+# Регистрации из нескольких процессов и потоков сразу: users.json меняется
+# чтением и перезаписью целиком, и ни один пользователь не должен потеряться
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_parallel_registrations(workdir, monkeypatch, backend):
+    monkeypatch.setenv("PM_STORAGE_BACKEND", backend)
+    context = multiprocessing.get_context("spawn")
+    batches = [[f"user{worker}-{i}" for i in range(THREADS * 3)] for worker in range(PROCESSES)]
+
+    with ProcessPoolExecutor(PROCESSES, mp_context=context) as pool:
+        for future in [pool.submit(_register, *batch) for batch in batches]:
+            future.result()
+
+    expected = [username for batch in batches for username in batch]
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        assert pool.submit(_registered, *expected).result() == expected
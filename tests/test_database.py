@@ -0,0 +1,38 @@
+import json
+import os
+
+import pytest
+
+
+# В Windows os.replace отказывает, пока файл открыт в другом потоке;
+# замена повторяется и удаётся, когда файл закрыли
+def test_atomic_write_retries_replace_of_an_open_file(workdir, monkeypatch):
+    from app import database
+
+    replace, failures = os.replace, []
+
+    def busy_replace(src, dst):
+        if len(failures) < 3:
+            failures.append(dst)
+            raise PermissionError(13, "The process cannot access the file", dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(database.os, "replace", busy_replace)
+    database.write_json_atomic("data.json", {"a": 1})
+    assert len(failures) == 3
+    with open("data.json", encoding="utf-8") as f:
+        assert json.load(f) == {"a": 1}
+    assert sorted(os.listdir(".")) == ["data.json", "venv"]
+
+
+def test_atomic_write_gives_up_and_cleans_up(workdir, monkeypatch):
+    from app import database
+
+    def busy_replace(src, dst):
+        raise PermissionError(13, "The process cannot access the file", dst)
+
+    monkeypatch.setattr(database.os, "replace", busy_replace)
+    monkeypatch.setattr(database.time, "sleep", lambda seconds: None)
+    with pytest.raises(PermissionError):
+        database.write_json_atomic("data.json", {"a": 1})
+    assert sorted(os.listdir(".")) == ["venv"]
@@ -0,0 +1,70 @@
+import jwt
+import pytest
+
+
+def _tokens():
+    from app.config import settings
+    from app.sessions import SessionTokens
+    return SessionTokens(settings.session_ttl, settings.session_key_ttl, settings.session_key_cache_size)
+
+
+# Пустой файл секрета (сбой между созданием и записью) не должен стать ключом подписи:
+# иначе токен для любого пользователя подписывается пустым ключом
+@pytest.mark.parametrize("content", ["", "short\n"])
+def test_empty_or_short_secret_file_is_replaced(workdir, content):
+    from app.sessions import SESSION_SECRET_FILE
+    with open(SESSION_SECRET_FILE, "w", encoding="utf-8") as f:
+        f.write(content)
+
+    tokens = _tokens()
+    assert len(tokens.secret) >= 32
+    with open(SESSION_SECRET_FILE, "r", encoding="utf-8") as f:
+        assert f.read().encode() == tokens.secret
+    if content.strip():
+        # пустым ключом новые версии PyJWT подписывать отказываются, короткий подделать можно
+        forged = jwt.encode({"sub": "alice", "kh": "x", "jti": "x", "exp": 2 ** 40}, content.strip(), algorithm="HS256")
+        assert tokens.verify(forged) is None
+    # другой процесс (здесь — другой экземпляр) получает тот же секрет
+    assert _tokens().secret == tokens.secret
+
+
+def test_short_configured_secret_is_rejected(workdir, monkeypatch):
+    from app.config import settings
+    monkeypatch.setattr(settings, "session_secret", "too-short")
+    with pytest.raises(RuntimeError):
+        _tokens().secret
+
+
+# Выход отзывает всю сессию: и токен, выданный при входе, и перевыпущенный после смены
+# ключа. Отзыв лежит в файле и виден другим процессам (здесь — другому экземпляру).
+def test_logout_revokes_reissued_tokens_of_the_session(workdir, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.config import settings
+    from app.crypto import generate_user_key
+    from app.main import app
+    from app.models import User
+    from app.sessions import SESSION_COOKIE, session_tokens
+    from app.storage import storage
+
+    monkeypatch.setattr(settings, "session_mode", "token")
+    user = User(username="alice", hashed_password="-", encrypted_user_key=generate_user_key())
+    storage.add_user(user)
+    original = session_tokens.issue(user)
+    other = session_tokens.issue(user)
+
+    client = TestClient(app, cookies={SESSION_COOKIE: original})
+    assert client.post("/passwords/rotate-key").status_code == 202
+    response = client.get("/passwords/", follow_redirects=False)
+    assert response.status_code == 200, response.text
+    reissued = response.cookies.get(SESSION_COOKIE)
+    assert reissued and reissued != original
+
+    client.cookies.set(SESSION_COOKIE, reissued)
+    client.get("/logout", follow_redirects=False)
+
+    for token in (original, reissued):
+        stale = TestClient(app, cookies={SESSION_COOKIE: token})
+        assert stale.get("/passwords/", follow_redirects=False).status_code == 303
+        assert _tokens().verify(token) is None
+    # другой вход того же пользователя не затронут
+    assert _tokens().verify(other) is not None
@@ -0,0 +1,102 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+# Синхронизация (/passwords/sync) после перезапуска: версии хранилища, отметки
+# об удалении и horizon должны читаться с диска такими же, какими были записаны
+USERNAME = "alice"
+
+
+# Функции ниже выполняются в дочерних процессах (spawn): каждый — отдельный запуск приложения
+def _apply(*ops):
+    from app.crypto import generate_user_key
+    from app.models import User
+    from app.storage import storage
+
+    if storage.get_user(USERNAME) is None:
+        storage.add_user(User(username=USERNAME, hashed_password="-", encrypted_user_key=generate_user_key()))
+    ids = {r["title"]: r["id"] for r in storage.list_records(USERNAME)}
+    for op, title in ops:
+        if op == "create":
+            ids[title] = storage.create_record(USERNAME, {"title": title, "login": "login", "encrypted_password": "-"})["id"]
+        else:
+            assert storage.delete_record(USERNAME, ids[title])
+    return ids
+
+
+def _changes(*since):
+    from app.storage import storage
+    return [storage.record_changes(USERNAME, s) for s in since]
+
+
+# Снимок с тем же состоянием, что уже записано в журнале: так бывает, когда строки стояли
+# в очереди при начале свёртки или процесс упал, не успев удалить .compacting
+def _snapshot_over_journal(journal_name):
+    import os
+    from app.database import RECORDS_FILE, RECORDS_JOURNAL_FILE, records_store, write_json_atomic
+
+    _changes(0)  # загружает хранилище с диска
+    write_json_atomic(RECORDS_FILE, records_store.dump_data())
+    if journal_name != "journal":
+        os.replace(RECORDS_JOURNAL_FILE, RECORDS_JOURNAL_FILE + "." + journal_name)
+
+
+def _restart_and_migrate(since, sqlite_path):
+    from app.database import records_store
+    from app.storage import SqliteStorage, migrate_json_to_sqlite
+
+    changes = _changes(*since)
+    migrate_json_to_sqlite(sqlite_path)
+    deleted = records_store.dump_data()["vaults"][USERNAME]["deleted"]
+    return deleted, changes, [SqliteStorage(sqlite_path).record_changes(USERNAME, s) for s in since]
+
+
+def _run(func, *args):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(func, *args).result()
+
+
+def _ids(changes):
+    version, records, deleted = changes
+    return version, sorted(r["title"] for r in records), deleted
+
+
+# Строки журнала, которые уже есть в снимке, при перезапуске пропускаются: удаление
+# не записывается второй раз, и клиент не получает его в синхронизации дважды.
+# Те же данные после переноса в SQLite.
+@pytest.mark.parametrize("journal_name", ["journal", "compacting"])
+def test_replay_skips_journal_lines_already_in_snapshot(workdir, monkeypatch, journal_name):
+    monkeypatch.setenv("PM_RECORDS_STORAGE", "journal")
+    ids = _run(_apply, ("create", "a"), ("create", "b"), ("delete", "a"))
+    _run(_snapshot_over_journal, journal_name)
+
+    since = (0, 2, 3)
+    deleted, json_changes, sqlite_changes = _run(_restart_and_migrate, since, "vault.db")
+    assert deleted == [[3, ids["a"]]]
+    for changes in (json_changes, sqlite_changes):
+        assert [_ids(c) for c in changes] == [(3, ["b"], []), (3, [], [ids["a"]]), (3, [], [])]
+
+
+# Хранятся удаления только за последние PM_SYNC_RETENTION версий; клиенту, который
+# синхронизировался раньше самого свежего забытого удаления (horizon), нужна полная синхронизация
+@pytest.mark.parametrize("env", [
+    {"PM_RECORDS_STORAGE": "snapshot"},
+    {"PM_RECORDS_STORAGE": "journal", "PM_JOURNAL_MAX_OPS": "3"},
+    {"PM_STORAGE_BACKEND": "sqlite"},
+], ids=lambda env: "-".join(env.values()))
+def test_deletions_beyond_retention_force_full_resync(workdir, monkeypatch, env):
+    for name, value in {**env, "PM_SYNC_RETENTION": "2"}.items():
+        monkeypatch.setenv(name, value)
+    titles = ["r1", "r2", "r3", "r4"]
+    # keep — версия 1, r1..r4 — версии 2..5, их удаления — версии 6..9
+    ids = _run(_apply, ("create", "keep"), *[("create", t) for t in titles], *[("delete", t) for t in titles])
+
+    # удаления r1 и r2 (версии 6 и 7) забыты, horizon = 7; читает новый процесс
+    changes = _run(_changes, 0, 6, 7, 8, 9, 10)
+    assert _ids(changes[0]) == (9, ["keep"], [])
+    assert changes[1] is None
+    assert _ids(changes[2]) == (9, [], [ids["r3"], ids["r4"]])
+    assert _ids(changes[3]) == (9, [], [ids["r4"]])
+    assert _ids(changes[4]) == (9, [], [])
+    assert changes[5] is None